@@ -0,0 +1,89 @@
+"""
+Text analyzers: turn a message (or a query) into index terms. The same
+analyzer must be used when indexing and when searching.
+
+    whitespace : m.split(), the original behaviour (PIndex relies on it to
+                 find the roman numeral headings of the sonnets)
+    standard   : lowercase, punctuation stripped, CJK runs cut into
+                 overlapping bigrams ("你好世界" -> 你好 好世 世界)
+    english    : standard plus light suffix stemming
+
+Each analyzer is compiled into one regular expression, so a message is
+scanned once; only CJK runs and stemming need extra work per token.
+"""
+import functools
+import re
+
+# Hiragana/Katakana, CJK Extension A, CJK Unified Ideographs, CJK Compatibility, Hangul
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+
+# tried in order, first match wins; (suffix, replacement)
+STEM_SUFFIXES = (("'s", ''), ('ingly', ''), ('edly', ''), ('ness', ''), ('ment', ''), ('ies', 'y'),
+                 ('ied', 'y'), ('ing', ''), ('ed', ''), ('ly', ''), ('es', ''), ('s', ''))
+STEM_MIN = 3    # never stem a word down to fewer letters than this
+
+
+@functools.lru_cache(maxsize=65536)
+def stem(word):
+    # crude English stemmer: love, loves, loved, loving -> lov. Cached: chat
+    # reuses the same few thousand words over and over
+    for suffix, repl in STEM_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= STEM_MIN:
+            if suffix == 's' and word.endswith('ss'):
+                break
+            word = word[:len(word) - len(suffix)] + repl
+            break
+    if word.endswith('e') and not word.endswith('ee') and len(word) > STEM_MIN:
+        word = word[:-1]
+    return word
+
+
+class Analyzer:
+    def __init__(self, name, lowercase=True, strip_punct=True, stemming=False, cjk_bigrams=True):
+        self.name = name
+        self.lowercase = lowercase
+        self.stemming = stemming
+        self.cjk_bigrams = cjk_bigrams
+        # '\\S+' without CJK bigrams is exactly str.split(), at twice the speed
+        self.split = not strip_punct and not cjk_bigrams
+        if strip_punct:
+            # letters and digits, with inner apostrophes (summer's, don't)
+            word = "[^\\W_%s]+(?:'[^\\W_%s]+)*" % (CJK_CHARS, CJK_CHARS)
+        else:
+            word = '[^\\s%s]+' % CJK_CHARS if cjk_bigrams else '\\S+'
+        if cjk_bigrams:
+            self.pattern = re.compile('([%s]+)|(%s)' % (CJK_CHARS, word))
+        else:
+            self.pattern = re.compile(word)
+
+    def __call__(self, m):
+        if self.lowercase:
+            m = m.lower()
+        if self.split:
+            words = m.split()
+            return [stem(w) for w in words] if self.stemming else words
+        if not self.cjk_bigrams:
+            words = self.pattern.findall(m)
+            return [stem(w) for w in words] if self.stemming else words
+        tokens = []
+        for cjk, word in self.pattern.findall(m):
+            if word:
+                tokens.append(stem(word) if self.stemming else word)
+            elif len(cjk) == 1:
+                tokens.append(cjk)
+            else:
+                tokens.extend(cjk[i:i + 2] for i in range(len(cjk) - 1))
+        return tokens
+
+
+WHITESPACE = Analyzer('whitespace', lowercase=False, strip_punct=False, cjk_bigrams=False)
+STANDARD = Analyzer('standard')
+ENGLISH = Analyzer('english', stemming=True)
+ANALYZERS = {a.name: a for a in (WHITESPACE, STANDARD, ENGLISH)}
+DEFAULT_ANALYZER = STANDARD.name
+
+
+def get_analyzer(name):
+    if name not in ANALYZERS:
+        raise ValueError("unknown analyzer: " + str(name))
+    return ANALYZERS[name]
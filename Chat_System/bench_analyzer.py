@@ -0,0 +1,46 @@
+"""
+Benchmark for the analyzers in analyzer.py.
+
+Tokenizes AllSonnets.txt (repeated REPEAT times) with each analyzer and
+reports throughput, the size of the term dictionary it produces and how many
+lines a few everyday queries find once the sonnets are indexed with it.
+
+    python bench_analyzer.py [--repeat 20]
+"""
+import argparse
+import time
+
+from analyzer import ANALYZERS
+from indexer import Index
+
+QUERIES = ['love', 'Love', 'beauty', '"summer\'s day"', 'rose']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='analyzer benchmark')
+    parser.add_argument('--repeat', type=int, default=20, help='times to tokenize the sonnets')
+    args = parser.parse_args()
+    with open('AllSonnets.txt') as f:
+        lines = [l.rstrip() for l in f]
+
+    print("%-11s %12s %10s  %s" % ("analyzer", "lines/s", "terms", "  ".join("%-8s" % q[:8] for q in QUERIES)))
+    for name, analyze in ANALYZERS.items():
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for l in lines:
+                analyze(l)
+        elapsed = time.perf_counter() - start
+        index = Index('bench', name)
+        for l in lines:
+            index.add_msg_and_index(l)
+        hits = [index.search_top(q, limit=1)[0] for q in QUERIES]
+        print("%-11s %12.0f %10d  %s" % (name, len(lines) * args.repeat / elapsed, len(index.index),
+                                         "  ".join("%-8d" % h for h in hits)))
+
+    sample = '今天我们一起去图书馆学习, then grab coffee!'
+    for name, analyze in ANALYZERS.items():
+        print("%-11s %s" % (name, analyze(sample)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Microbenchmark: recv syscalls per message, myrecv vs FrameDecoder.
+
+A sender pipelines a burst of chat frames over a socketpair; the
+receiver drains them either with one myrecv() call per message (two or
+more recv() calls each) or with FrameDecoder (one recv_into() per
+readiness event, then every complete frame in the buffer).
+
+    python bench_decoder.py
+"""
+import json
+import socket
+import threading
+import time
+
+from chat_utils import mysend, myrecv, frame_msg, FrameDecoder, PROTO_V1, PROTO_V2
+
+
+class CountingSock:
+    # forwards recv / recv_into and counts the calls
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, n):
+        self.calls += 1
+        return self.sock.recv(n)
+
+    def recv_into(self, buf, n=0):
+        self.calls += 1
+        return self.sock.recv_into(buf, n)
+
+
+def sender(sock, frames):
+    sock.sendall(b''.join(frames))
+    sock.close()
+
+
+def run(proto, n_msgs, use_decoder):
+    a, b = socket.socketpair()
+    msg = json.dumps({"action": "exchange", "from": "[alice]", "message": "hello there, how are you?"})
+    frames = [frame_msg(msg, proto)] * n_msgs
+    t = threading.Thread(target=sender, args=(a, frames))
+    t.start()
+    s = CountingSock(b)
+    got = 0
+    start = time.perf_counter()
+    if use_decoder:
+        decoder = FrameDecoder(proto)
+        while got < n_msgs:
+            if decoder.feed_from(s) == 0:
+                break
+            for payload in decoder.frames():
+                got += 1
+    else:
+        while got < n_msgs and myrecv(s, proto):
+            got += 1
+    elapsed = time.perf_counter() - start
+    t.join()
+    b.close()
+    return s.calls / got, got / elapsed
+
+
+def main():
+    n_msgs = 100000
+    print("%-6s %-12s %14s %12s" % ("proto", "reader", "syscalls/msg", "msgs/s"))
+    for proto in (PROTO_V1, PROTO_V2):
+        for use_decoder in (False, True):
+            calls, rate = run(proto, n_msgs, use_decoder)
+            print("%-6s %-12s %14.3f %12.0f" % ("v%d" % proto, "decoder" if use_decoder else "myrecv",
+                                               calls, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Benchmark: group fan-out throughput against group size.
+
+Compares the old path (JSON encoding + framing once per recipient) with
+chat_session.fanout (the dict is serialized and framed once per wire format,
+the bytes shared), both
+followed by draining every session into a null socket.
+
+    python bench_fanout.py
+"""
+import time
+
+from chat_utils import frame_msg
+from chat_codec import JSON
+from chat_session import Session, fanout
+
+
+class NullSock:
+    def send(self, data):
+        return len(data)
+
+
+def per_recipient(sessions, msg):
+    for session in sessions:
+        session.enqueue(frame_msg(JSON.encode(msg)))
+
+
+def encode_once(sessions, msg):
+    fanout(sessions, msg)
+
+
+def run(send, group_size, n_msgs):
+    sessions = [Session(NullSock()) for _ in range(group_size)]
+    msg = {"action": "exchange", "from": "[alice]", "message": "Shall I compare thee to a summer's day? " * 4}
+    start = time.perf_counter()
+    for _ in range(n_msgs):
+        send(sessions, msg)
+        for session in sessions:
+            session.flush()
+    return time.perf_counter() - start
+
+
+def main():
+    print("%8s %14s %14s %9s" % ("members", "per-recip/s", "encode-once/s", "speedup"))
+    for group_size in (2, 10, 50, 200, 1000, 5000):
+        n_msgs = max(20, 200000 // group_size)
+        old = run(per_recipient, group_size, n_msgs)
+        new = run(encode_once, group_size, n_msgs)
+        deliveries = n_msgs * group_size
+        print("%8d %14.0f %14.0f %8.2fx" % (group_size, deliveries / old, deliveries / new, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Scaling benchmark for chat_group.Group.
+
+Joins N users, pairs them up and grows groups of GROUP_SIZE members, then
+times list_me (run on every exchange), connect and disconnect. With the
+member -> group reverse index the per-operation cost stays flat as N
+grows to 100k users; it only depends on the size of the caller's group.
+
+    python bench_group.py
+"""
+import random
+import time
+
+from chat_group import Group
+
+GROUP_SIZE = 8
+
+
+def build(n_users):
+    g = Group()
+    names = ['user%d' % i for i in range(n_users)]
+    for name in names:
+        g.join(name)
+    # groups of GROUP_SIZE: everyone connects to the first member of the block
+    for i in range(0, n_users - GROUP_SIZE + 1, GROUP_SIZE):
+        for j in range(i + 1, i + GROUP_SIZE):
+            g.connect(names[j], names[i])
+    return g, names
+
+
+def per_op(fn, args):
+    start = time.perf_counter()
+    for a in args:
+        fn(*a)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def main():
+    print("%8s %8s %12s %12s %14s" % ("users", "groups", "list_me us", "connect us", "disconnect us"))
+    for n_users in (1000, 10000, 100000):
+        g, names = build(n_users)
+        sample = random.sample(names, 1000)
+        t_list = per_op(g.list_me, [(n,) for n in sample])
+        movers = sample[:500]
+        pairs = [(m, t) for m, t in zip(movers, random.sample(names, 500)) if m != t]
+        t_conn = per_op(g.connect, pairs)
+        t_disc = per_op(g.disconnect, [(n,) for n in movers])
+        print("%8d %8d %12.2f %12.2f %14.2f" % (n_users, len(g.chat_grps), t_list, t_conn, t_disc))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Memory / throughput benchmark for indexer.Index.
+
+Indexes AllSonnets.txt repeated up to LINES lines, once with the old
+structure (a plain class, postings in Python lists) and once with the
+current Index (__slots__, interned terms, array('I') postings), and reports
+indexing rate, memory held by the index and the size of the delta + varint
+encoding used when an Index is pickled. Then times boolean / phrase
+matching and ranked top-k search on the result.
+
+    python bench_indexer.py [--lines 1000000]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from analyzer import WHITESPACE
+from indexer import Index, encode_postings, parse_query
+
+
+class ListIndex:
+    # the structure Index had before: list postings, no slots
+    def __init__(self, name):
+        self.name = name
+        self.msgs = []
+        self.index = {}
+        self.total_msgs = 0
+        self.total_words = 0
+
+    def add_msg_and_index(self, m):
+        self.msgs.append(m)
+        self.total_msgs += 1
+        l = self.total_msgs - 1
+        words = m.split()
+        self.total_words += len(words)
+        for wd in words:
+            if wd not in self.index:
+                self.index[wd] = [l, ]
+            else:
+                self.index[wd].append(l)
+
+
+def load_lines(n_lines):
+    with open('AllSonnets.txt') as f:
+        sonnets = [l.rstrip() for l in f]
+    lines = []
+    while len(lines) < n_lines:
+        lines.extend(sonnets)
+    return lines[:n_lines]
+
+
+def measure(cls, lines):
+    # wall time without tracing, then memory with tracing on a second build
+    gc.collect()
+    start = time.perf_counter()
+    index = cls('bench')
+    for l in lines:
+        index.add_msg_and_index(l)
+    elapsed = time.perf_counter() - start
+    del index
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = cls('bench')
+    for l in lines:
+        index.add_msg_and_index(l)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return index, elapsed, used
+
+
+QUERIES = ['love', 'rose beauty', 'love NOT the', '"my love"', 'thee OR thou', 'the']
+
+
+def time_queries(index):
+    print("%-16s %9s %10s %12s" % ("query", "matches", "match ms", "top-20 ms"))
+    for q in QUERIES:
+        clauses = parse_query(q, index.analyzer)
+        start = time.perf_counter()
+        lines = index.match(clauses)
+        t_match = time.perf_counter() - start
+        start = time.perf_counter()
+        index.search_top(q)
+        t_top = time.perf_counter() - start
+        print("%-16s %9d %10.3f %12.3f" % (q, len(lines), t_match * 1e3, t_top * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='indexer benchmark')
+    parser.add_argument('--lines', type=int, default=1000000, help='lines to index')
+    args = parser.parse_args()
+    lines = load_lines(args.lines)
+    # the message strings are shared by both runs, so memory is the index itself
+    print("%-12s %10s %12s %12s" % ("structure", "seconds", "lines/s", "index MB"))
+    # same m.split() terms for both, so only the structure differs
+    for label, cls in (("list", ListIndex), ("array", lambda name: Index(name, WHITESPACE.name))):
+        index, elapsed, used = measure(cls, lines)
+        print("%-12s %10.2f %12.0f %12.1f" % (label, elapsed, len(lines) / elapsed, used / 2 ** 20))
+    encoded = sum(len(encode_postings(p)) for p in index.index.values())
+    postings = sum(len(p) for p in index.index.values())
+    print("%d postings, %d terms; delta+varint: %.1f MB (%.2f bytes/posting)"
+          % (postings, len(index.index), encoded / 2 ** 20, encoded / postings))
+    time_queries(index)
+
+
+if __name__ == "__main__":
+    main()
@@ -152,6 +152,9 @@ class ChatGUI:
             result = self.client.login()
             if result is True:
                 self.switch_to_chat()
+            elif result is False and self.client.login_status == 'bad_name':
+                self.lbl_error.config(text="⚠ Invalid username (up to 64 characters, no leading \".\", no \"/\" or \"\\\")")
+                self.client.system_msg = ''
             elif result is False:
                 self.lbl_error.config(text="⚠ Username already taken")
                 self.client.system_msg = ''
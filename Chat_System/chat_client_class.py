@@ -4,6 +4,7 @@ import select
 import sys
 import json
 from chat_utils import *
+from chat_codec import JSON, CODECS, CODEC_PREFERENCE
 import client_state_machine as csm
 import threading
 
@@ -18,7 +19,12 @@ class Client:
         self.peer_msg = ''
         self.args = args
         self.name = ''
+        self.login_status = None    # status of the last login reply ('ok', 'duplicate', 'bad_name')
         self.socket = None
+        self.proto = PROTO_V1
+        self.codec = JSON
+        self.compress = False
+        self.decoder = FrameDecoder()
 
     def quit(self):
         self.socket.shutdown(socket.SHUT_RDWR)
@@ -31,7 +37,8 @@ class Client:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         svr = SERVER if self.args.d == None else (self.args.d, CHAT_PORT)
         self.socket.connect(svr)
-        self.sm = csm.ClientSM(self.socket)
+        self.decoder = FrameDecoder()
+        self.sm = csm.ClientSM(self.socket, self.decoder)
         reading_thread = threading.Thread(target=self.read_input)
         reading_thread.daemon = True
         reading_thread.start()
@@ -40,25 +47,27 @@ class Client:
         return
 
     def send(self, msg):
-        mysend(self.socket, msg)
+        mysend(self.socket, self.codec.encode(msg), self.proto, self.compress)
 
     def recv(self):
-        return myrecv(self.socket)
+        return self.codec.decode(self.decoder.recv(self.socket))
 
     def get_msgs(self):
         read, write, error = select.select([self.socket], [], [], 0)
         my_msg = ''
-        peer_msg = ''
+        peer_msgs = []
 
-        # 1. 处理来自服务器的信息
+        # 1. 处理来自服务器的信息: 一次读入, 取出缓冲区里所有完整的消息
         if self.socket in read:
-            peer_msg = self.recv()
+            if self.decoder.feed_from(self.socket) == 0:
+                print('disconnected')
+        peer_msgs = [self.codec.decode(payload) for payload in self.decoder.frames()]
 
         # 2. 处理来自 console / GUI 的信息
         if len(self.console_input) > 0:
             my_msg = self.console_input.pop(0)
 
-        return my_msg, peer_msg
+        return my_msg, peer_msgs
 
     def output(self):
         if len(self.system_msg) > 0:
@@ -66,13 +75,22 @@ class Client:
             self.system_msg = ''
 
     def login(self):
-        my_msg, peer_msg = self.get_msgs()
+        my_msg, peer_msgs = self.get_msgs()
         if len(my_msg) > 0:
             self.name = my_msg
-            msg = json.dumps({"action": "login", "name": self.name})
+            msg = {"action": "login", "name": self.name, "proto": PROTO_MAX, "codecs": CODEC_PREFERENCE,
+                   "compress": ZDICT_VERSION}
             self.send(msg)
-            response = json.loads(self.recv())
+            response = self.recv()
+            self.login_status = response["status"]
             if response["status"] == 'ok':
+                # 旧服务器不认识 proto/codecs/compress 字段, 回复里没有就继续用 v1 + JSON
+                self.proto = response.get("proto", PROTO_V1)
+                self.codec = CODECS.get(response.get("codec"), JSON)
+                self.compress = response.get("compress") == ZDICT_VERSION
+                self.sm.set_proto(self.proto)  # also switches the shared decoder
+                self.sm.set_codec(self.codec)
+                self.sm.set_compress(self.compress)
                 self.state = S_LOGGEDIN
                 self.sm.set_state(S_LOGGEDIN)
                 self.sm.set_myname(self.name)
@@ -81,6 +99,9 @@ class Client:
             elif response["status"] == 'duplicate':
                 self.system_msg += 'Duplicate username, try again'
                 return False
+            elif response["status"] == 'bad_name':
+                self.system_msg += 'Names cannot start with "." or contain "/" or "\\", try again'
+                return False
         else:
             return (False)
 
@@ -101,7 +122,7 @@ class Client:
         [新增] 专门用于发送机器人请求的方法
         使用 self.send() 确保通过 mysend 添加正确的协议头
         """
-        msg = json.dumps({"action": "bot_ask", "message": question})
+        msg = {"action": "bot_ask", "message": question}
         self.send(msg)
 
     def process(self):
@@ -127,26 +148,23 @@ class Client:
         """
         核心处理逻辑
         """
-        my_msg, peer_msg = self.get_msgs()
-
-        # ==========================================================
-        # [关键修改] 在这里拦截 Bot 的消息
-        # 避免传给 State Machine (因为 SM 不认识 bot_res)
-        # ==========================================================
-        if len(peer_msg) > 0:
-            try:
-                msg_json = json.loads(peer_msg)
-                if msg_json.get("action") == "bot_res":
-                    # 直接格式化消息放入 buffer，不经过 SM
-                    self.system_msg += "[AI Robot]: " + msg_json["message"] + "\n"
-                    # 清空 peer_msg，防止状态机重复处理
-                    peer_msg = ""
-            except Exception as e:
-                # 可能是普通聊天消息或者 JSON 解析失败，交给 SM 处理
-                pass
-
-        # 正常的聊天逻辑交给状态机
-        self.system_msg += self.sm.proc(my_msg, peer_msg)
+        my_msg, peer_msgs = self.get_msgs()
+
+        # 本轮收到的所有消息一次处理完, 自己的输入只随第一条交给状态机
+        for peer_msg in peer_msgs or ['']:
+            # ==========================================================
+            # [关键修改] 在这里拦截 Bot 的消息
+            # 避免传给 State Machine (因为 SM 不认识 bot_res)
+            # ==========================================================
+            if len(peer_msg) > 0 and peer_msg.get("action") == "bot_res":
+                # 直接格式化消息放入 buffer，不经过 SM
+                self.system_msg += "[AI Robot]: " + peer_msg["message"] + "\n"
+                # 清空 peer_msg，防止状态机重复处理
+                peer_msg = ""
+
+            # 正常的聊天逻辑交给状态机
+            self.system_msg += self.sm.proc(my_msg, peer_msg)
+            my_msg = ''
 
     # 保留原有的 run_chat 以兼容命令行模式
     def run_chat(self):
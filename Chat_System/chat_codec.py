@@ -0,0 +1,232 @@
+"""
+Message codecs, negotiated per connection at login.
+
+    json : the original format, always available (and the only one v1 supports)
+    bin  : compact binary (MessagePack wire format) with the action name sent
+           as a small integer opcode. Uses the msgpack package when it is
+           installed and falls back to the pure-Python packer below, which
+           produces the same bytes, so either end may lack msgpack.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# opcodes are positions in this list + 1: only ever append to it
+ACTIONS = ["login", "connect", "exchange", "bot_ask", "bot_res",
+           "list", "poem", "time", "search", "disconnect",
+           "subscribe_presence", "unsubscribe_presence", "presence",
+           "room_join", "room_leave", "rooms", "history", "metrics"]
+ACTION_CODES = {name: i + 1 for i, name in enumerate(ACTIONS)}
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, msg):
+        return json.dumps(msg).encode()
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class CompactCodec:
+    name = "bin"
+
+    def encode(self, msg):
+        code = ACTION_CODES.get(msg.get("action"))
+        if code is not None:
+            msg = dict(msg)
+            msg["action"] = code
+        return packb(msg)
+
+    def decode(self, payload):
+        msg = unpackb(payload)
+        if not isinstance(msg, dict):
+            raise ValueError("message is not a map")
+        action = msg.get("action")
+        if isinstance(action, int):
+            if not 0 < action <= len(ACTIONS):
+                raise ValueError("unknown opcode %d" % action)
+            msg["action"] = ACTIONS[action - 1]
+        return msg
+
+
+JSON = JsonCodec()
+COMPACT = CompactCodec()
+CODECS = {JSON.name: JSON, COMPACT.name: COMPACT}
+CODEC_PREFERENCE = [COMPACT.name, JSON.name]
+
+
+def pick_codec(offered):
+    # first codec in the client's list that we also speak, json otherwise
+    for name in offered or []:
+        if name in CODECS:
+            return CODECS[name]
+    return JSON
+
+
+# ==============================================================================
+# Pure-Python MessagePack subset: nil, bool, int, float, str, bin, array, map
+# ==============================================================================
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out += b'\xcc' + struct.pack('B', obj)
+        elif 0 <= obj <= 0xffff:
+            out += b'\xcd' + struct.pack('>H', obj)
+        elif 0 <= obj <= 0xffffffff:
+            out += b'\xce' + struct.pack('>I', obj)
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out += b'\xcf' + struct.pack('>Q', obj)
+        elif -0x80 <= obj < 0:
+            out += b'\xd0' + struct.pack('b', obj)
+        elif -0x8000 <= obj < 0:
+            out += b'\xd1' + struct.pack('>h', obj)
+        elif -0x80000000 <= obj < 0:
+            out += b'\xd2' + struct.pack('>i', obj)
+        elif -0x8000000000000000 <= obj < 0:
+            out += b'\xd3' + struct.pack('>q', obj)
+        else:
+            raise ValueError("integer out of range")
+    elif isinstance(obj, float):
+        out += b'\xcb' + struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        n = len(data)
+        if n < 32:
+            out.append(0xa0 | n)
+        elif n <= 0xff:
+            out += b'\xd9' + struct.pack('B', n)
+        elif n <= 0xffff:
+            out += b'\xda' + struct.pack('>H', n)
+        else:
+            out += b'\xdb' + struct.pack('>I', n)
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        n = len(obj)
+        if n <= 0xff:
+            out += b'\xc4' + struct.pack('B', n)
+        elif n <= 0xffff:
+            out += b'\xc5' + struct.pack('>H', n)
+        else:
+            out += b'\xc6' + struct.pack('>I', n)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            out.append(0x90 | n)
+        elif n <= 0xffff:
+            out += b'\xdc' + struct.pack('>H', n)
+        else:
+            out += b'\xdd' + struct.pack('>I', n)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            out.append(0x80 | n)
+        elif n <= 0xffff:
+            out += b'\xde' + struct.pack('>H', n)
+        else:
+            out += b'\xdf' + struct.pack('>I', n)
+        for k, v in obj.items():
+            _pack(k, out)
+            _pack(v, out)
+    else:
+        raise TypeError("cannot pack %s" % type(obj).__name__)
+
+
+# fixed-width formats: type byte -> (struct format, size)
+_FIXED = {
+    0xcc: ('B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+}
+# length-prefixed formats: type byte -> (length format, length size, kind)
+_SIZED = {
+    0xd9: ('B', 1, 'str'), 0xda: ('>H', 2, 'str'), 0xdb: ('>I', 4, 'str'),
+    0xc4: ('B', 1, 'bin'), 0xc5: ('>H', 2, 'bin'), 0xc6: ('>I', 4, 'bin'),
+    0xdc: ('>H', 2, 'array'), 0xdd: ('>I', 4, 'array'),
+    0xde: ('>H', 2, 'map'), 0xdf: ('>I', 4, 'map'),
+}
+
+
+def _unpack(data, pos):
+    t = data[pos]
+    pos += 1
+    if t < 0x80:
+        return t, pos
+    if t >= 0xe0:
+        return t - 0x100, pos
+    if t == 0xc0:
+        return None, pos
+    if t == 0xc2:
+        return False, pos
+    if t == 0xc3:
+        return True, pos
+    if 0xa0 <= t <= 0xbf:
+        kind, n = 'str', t & 0x1f
+    elif 0x90 <= t <= 0x9f:
+        kind, n = 'array', t & 0x0f
+    elif 0x80 <= t <= 0x8f:
+        kind, n = 'map', t & 0x0f
+    elif t in _FIXED:
+        fmt, size = _FIXED[t]
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    elif t in _SIZED:
+        fmt, size, kind = _SIZED[t]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += size
+    else:
+        raise ValueError("unsupported type byte 0x%02x" % t)
+    if kind == 'str' or kind == 'bin':
+        if pos + n > len(data):
+            raise ValueError("truncated message")
+        raw = bytes(data[pos:pos + n])
+        return (raw.decode() if kind == 'str' else raw), pos + n
+    if kind == 'array':
+        items = []
+        for _ in range(n):
+            item, pos = _unpack(data, pos)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(n):
+        k, pos = _unpack(data, pos)
+        v, pos = _unpack(data, pos)
+        result[k] = v
+    return result, pos
+
+
+def packb(obj):
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def unpackb(data):
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    try:
+        obj, pos = _unpack(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError("truncated message")
+    if pos != len(data):
+        raise ValueError("trailing bytes after message")
+    return obj
@@ -4,21 +4,45 @@ Created on Sun Apr  5 09:58:31 2015
 
 @author: zhengzhang
 """
+import bisect
+import collections
+import json
+import os
+import sys
+
 S_ALONE = 0
 S_TALKING = 1
+STATE_NAMES = {S_ALONE: "alone", S_TALKING: "talking"}
+
+LIST_PAGE = 100         # default page size of the structured listing
+LIST_MAX_PAGE = 1000
+CHANGE_LOG = 10000      # presence changes kept for "since version N" deltas
+ROOM_NAME_MAX = 64
 
 #==============================================================================
 # Group class:
 # member fields:
 #   - An array of items, each a Member class
-#   - A dictionary that keeps who is a chat group
+#   - A dictionary that keeps who is a chat group (group key -> set of names)
+#   - A reverse index from member name to group key, so finding someone's
+#     group is O(1) instead of a scan over every group
+#   - A cache of each group's recipient tuple, dropped on membership change
+#   - A sorted list of member names, for cursor pagination and prefix search
+#   - A presence version, bumped on every join/leave/connect/disconnect,
+#     plus a bounded log of (version, name) changes for delta listings
+#   - Named rooms (room name -> set of names), independent of the chat
+#     groups: a user can be in many rooms, and membership survives logout
+#     (saved with save_rooms / load_rooms)
 # member functions:
 #    - join: first time in
 #    - leave: leave the system, and the group
 #    - list_my_peers: who is in chatting with me?
 #    - list_all: who is in the system, and the chat groups
+#    - list_page: one page of members, filtered by name prefix and/or state
+#    - changes_since: members whose presence changed after a given version
 #    - connect: connect to a peer in a chat group, and become part of the group
 #    - disconnect: leave the chat group but stay in the system
+#    - join_room / leave_room / room_members / rooms_of: named rooms
 #==============================================================================
 
 class Group:
@@ -26,75 +50,227 @@ class Group:
     def __init__(self):
         self.members = {}
         self.chat_grps = {}
+        self.member2grp = {}
+        self.grp_cache = {}
         self.grp_ever = 0
         self.grp_msg = {}
+        self.sorted_names = []
+        self.version = 0
+        self.changes = collections.deque(maxlen=CHANGE_LOG)
+        self.rooms = {}
+        self.member2rooms = {}
+        self.room_cache = {}
+        self.rooms_dirty = False
+
+    def touch(self, name):
+        self.version += 1
+        self.changes.append((self.version, name))
 
     def join(self, name):
         self.members[name] = S_ALONE
+        bisect.insort(self.sorted_names, name)
+        self.touch(name)
         return
 
     def is_member(self, name):
-        return name in self.members.keys()
+        return name in self.members
 
     def leave(self, name):
         self.disconnect(name)
         del self.members[name]
+        i = bisect.bisect_left(self.sorted_names, name)
+        del self.sorted_names[i]
+        self.touch(name)
         return
 
     def find_group(self, name):
-        found = False
-        group_key = 0
-        for k in self.chat_grps.keys():
-            if name in self.chat_grps[k]:
-                found = True
-                group_key = k
-                break
-        return found, group_key
+        group_key = self.member2grp.get(name, 0)
+        return group_key != 0, group_key
+
+    def group_members(self, group_key):
+        # cached tuple of everyone in the group, for message fan-out
+        members = self.grp_cache.get(group_key)
+        if members is None:
+            members = tuple(self.chat_grps.get(group_key, ()))
+            self.grp_cache[group_key] = members
+        return members
+
+    def add_to_group(self, name, group_key):
+        self.chat_grps[group_key].add(name)
+        self.member2grp[name] = group_key
+        self.members[name] = S_TALKING
+        self.grp_cache.pop(group_key, None)
+        self.touch(name)
+
+    def remove_from_group(self, name, group_key):
+        self.chat_grps[group_key].discard(name)
+        del self.member2grp[name]
+        self.members[name] = S_ALONE
+        self.grp_cache.pop(group_key, None)
+        self.touch(name)
 
     def connect(self, me, peer):
+        # returns the member of my old group left alone by the move, if any
         peer_in_group = False
+        if self.member2grp.get(me, 0) != 0 and self.member2grp.get(me) == self.member2grp.get(peer):
+            return None
+        # one group at a time: leave the current one first
+        left_alone = self.disconnect(me)
         #if peer is in a group, join it
         peer_in_group, group_key = self.find_group(peer)
         if peer_in_group == True:
             #print(peer, "is talking already, connect!")
-            self.chat_grps[group_key].append(me)
-            self.members[me] = S_TALKING
+            self.add_to_group(me, group_key)
         else:
             # otherwise, create a new group
             #print(peer, "is idle as well")
             self.grp_ever += 1
             group_key = self.grp_ever
-            self.chat_grps[group_key] = []
+            self.chat_grps[group_key] = set()
             self.grp_msg[group_key] = []
-            self.chat_grps[group_key].append(me)
-            self.chat_grps[group_key].append(peer)
-            self.members[me] = S_TALKING
-            self.members[peer] = S_TALKING
+            self.add_to_group(me, group_key)
+            self.add_to_group(peer, group_key)
         #print(self.list_me(me))
-        return
+        return left_alone
 
     def disconnect(self, me):
-        # find myself in the group, quit
+        # find myself in the group, quit; returns the peer left alone (and
+        # so dropped from the group too), if any
         in_group, group_key = self.find_group(me)
         if in_group == True:
-            self.chat_grps[group_key].remove(me)
-            self.members[me] = S_ALONE
+            self.remove_from_group(me, group_key)
             # peer may be the only one left as well...
             if len(self.chat_grps[group_key]) == 1:
-                peer = self.chat_grps[group_key].pop()
-                self.members[peer] = S_ALONE
+                peer = next(iter(self.chat_grps[group_key]))
+                self.remove_from_group(peer, group_key)
                 del self.chat_grps[group_key]
-        return
+                self.grp_cache.pop(group_key, None)
+                return peer
+        return None
+
+    # ==========================================================================
+    # Named rooms
+    # ==========================================================================
+    def join_room(self, name, room):
+        # creates the room on first join; False if already a member
+        members = self.rooms.get(room)
+        if members is None:
+            members = self.rooms[room] = set()
+        if name in members:
+            return False
+        # names are interned so thousands of room sets share one string each
+        name = sys.intern(name)
+        members.add(name)
+        self.member2rooms.setdefault(name, set()).add(room)
+        self.room_cache.pop(room, None)
+        self.rooms_dirty = True
+        return True
+
+    def leave_room(self, name, room):
+        # the room goes away with its last member; False if not a member
+        members = self.rooms.get(room)
+        if members is None or name not in members:
+            return False
+        members.discard(name)
+        mine = self.member2rooms[name]
+        mine.discard(room)
+        if not mine:
+            del self.member2rooms[name]
+        if not members:
+            del self.rooms[room]
+        self.room_cache.pop(room, None)
+        self.rooms_dirty = True
+        return True
+
+    def in_room(self, name, room):
+        return name in self.rooms.get(room, ())
+
+    def room_members(self, room):
+        # cached tuple of everyone in the room, for message fan-out
+        members = self.room_cache.get(room)
+        if members is None:
+            members = tuple(self.rooms.get(room, ()))
+            self.room_cache[room] = members
+        return members
+
+    def rooms_of(self, name):
+        return sorted(self.member2rooms.get(name, ()))
+
+    def save_rooms(self, path):
+        # write to a temp file and rename, so a crash never leaves half a file
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({room: sorted(members) for room, members in self.rooms.items()}, f)
+        os.replace(tmp, path)
+        self.rooms_dirty = False
+
+    def load_rooms(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        for room, members in saved.items():
+            for name in members:
+                self.join_room(name, room)
+        self.rooms_dirty = False
 
     def list_all(self):
         # a simple minded implementation
         full_list = "Users: ------------" + "\n"
         full_list += str(self.members) + "\n"
         full_list += "Groups: -----------" + "\n"
-        full_list += str(self.chat_grps) + "\n"
-        print(self.chat_grps)
+        # groups are sets now; show them as (sorted) lists, as before
+        full_list += str({key: sorted(names) for key, names in self.chat_grps.items()}) + "\n"
         return full_list
 
+    def describe(self, name):
+        # [name, state, group key] of a member, [name, None, 0] once gone
+        if name not in self.members:
+            return [name, None, 0]
+        return [name, STATE_NAMES[self.members[name]], self.member2grp.get(name, 0)]
+
+    def list_page(self, cursor=None, limit=LIST_PAGE, prefix="", state=None):
+        # members after `cursor` in name order, at most `limit` of them.
+        # Returns (entries, next cursor or None when there are no more).
+        limit = max(1, min(int(limit), LIST_MAX_PAGE))
+        names = self.sorted_names
+        if cursor:
+            i = bisect.bisect_right(names, cursor)
+        else:
+            i = bisect.bisect_left(names, prefix)
+        page = []
+        while i < len(names) and len(page) < limit:
+            name = names[i]
+            if not name.startswith(prefix):
+                if name > prefix:
+                    return page, None   # past the block of names with this prefix
+            elif state is None or STATE_NAMES[self.members[name]] == state:
+                page.append(self.describe(name))
+            i += 1
+        if i >= len(names):
+            return page, None
+        return page, page[-1][0] if page else names[i - 1]
+
+    def changes_since(self, version):
+        # members whose presence changed after `version`, one entry per name
+        # (the latest state wins). None if the log no longer reaches back
+        # that far and the caller has to list everything again.
+        if version >= self.version:
+            return []
+        if not self.changes or self.changes[0][0] > version + 1:
+            return None
+        changed = []
+        seen = set()
+        for v, name in reversed(self.changes):
+            if v <= version:
+                break
+            if name not in seen:
+                seen.add(name)
+                changed.append(self.describe(name))
+        changed.reverse()
+        return changed
+
     def list_all2(self, me):
         print("Users: ------------")
         print(self.members)
@@ -107,12 +283,12 @@ class Group:
 
     def list_me(self, me):
         # return a list, "me" followed by other peers in my group
-        if me in self.members.keys():
-            my_list = []
+        my_list = []
+        if me in self.members:
             my_list.append(me)
             in_group, group_key = self.find_group(me)
             if in_group == True:
-                for member in self.chat_grps[group_key]:
+                for member in self.group_members(group_key):
                     if member != me:
                         my_list.append(member)
         return my_list
@@ -0,0 +1,180 @@
+"""
+Write-ahead log of chat messages. Every message is appended here before it
+is delivered, under a monotonic id, so a crash no longer loses the history
+that only lived in memory.
+
+    chatlog/00000000000000000001.log   records with ids from 1
+    chatlog/00000000000000052311.log   ... the next segment starts at 52311
+
+A segment is rotated once it reaches segment_bytes. Each record is
+
+    length I, crc32 I, id Q, then `length` bytes of JSON
+
+fsync is group-committed: append() hands each record to the OS at once
+(the file is unbuffered, so a killed server loses nothing), and a flusher
+thread fsyncs everything appended during the last `window` seconds in one
+call. A message can then only be lost if the machine dies within the window;
+with window=0 every append is fsynced before it returns. wait_durable(id)
+blocks until a given message is on disk.
+
+read(after) replays the records with id > after, oldest first; a torn
+record at the end of the last segment (crash mid-write) is cut off when the
+log is opened.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+LOG_DIR = "chatlog"
+FSYNC_WINDOW = 0.01             # seconds of appends fsynced together; 0 = fsync every append
+SEGMENT_BYTES = 64 * 2 ** 20    # rotate to a new segment beyond this size
+
+RECORD = struct.Struct('<IIQ')
+SEGMENT_SUFFIX = '.log'
+
+
+def segment_name(first_id):
+    return '%020d%s' % (first_id, SEGMENT_SUFFIX)
+
+
+def scan_segment(path):
+    """(records, valid_bytes): the intact records of a segment file, in order."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    records = []
+    pos = 0
+    while pos + RECORD.size <= len(data):
+        length, crc, msg_id = RECORD.unpack_from(data, pos)
+        body = data[pos + RECORD.size:pos + RECORD.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        record = json.loads(body)
+        record["id"] = msg_id
+        records.append(record)
+        pos += RECORD.size + length
+    return records, pos
+
+
+class MessageLog:
+    def __init__(self, root=LOG_DIR, window=FSYNC_WINDOW, segment_bytes=SEGMENT_BYTES):
+        self.root = root
+        self.window = window
+        self.segment_bytes = segment_bytes
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.durable_cond = threading.Condition(self.lock)
+        self.segments = self.list_segments()   # first id of each segment, ascending
+        self.next_id = 1
+        if self.segments:
+            path = os.path.join(root, segment_name(self.segments[-1]))
+            records, valid = scan_segment(path)
+            if valid < os.path.getsize(path):
+                print(f"[MessageLog] dropping torn record at the end of {path}")
+                with open(path, 'r+b') as f:
+                    f.truncate(valid)
+            self.next_id = records[-1]["id"] + 1 if records else self.segments[-1]
+        else:
+            self.segments.append(self.next_id)
+        self.file = open(os.path.join(root, segment_name(self.segments[-1])), 'ab', buffering=0)
+        self.written = self.next_id - 1     # last id handed to the file
+        self.durable = self.written         # last id known to be fsynced
+        if window > 0:
+            t = threading.Thread(target=self.work, name='log-fsync')
+            t.daemon = True
+            t.start()
+
+    def list_segments(self):
+        return sorted(int(f[:-len(SEGMENT_SUFFIX)]) for f in os.listdir(self.root)
+                      if f.endswith(SEGMENT_SUFFIX) and f[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    @property
+    def last_id(self):
+        return self.next_id - 1
+
+    def append(self, record):
+        """Log record (a JSON-able dict); returns its id. Sets record["id"] and record["ts"]."""
+        with self.lock:
+            msg_id = self.next_id
+            self.next_id += 1
+            record["ts"] = round(time.time(), 3)
+            body = json.dumps({k: v for k, v in record.items() if k != "id"}).encode()
+            record["id"] = msg_id
+            if self.file.tell() >= self.segment_bytes:
+                self.rotate(msg_id)
+            self.file.write(RECORD.pack(len(body), zlib.crc32(body), msg_id) + body)
+            self.written = msg_id
+            if self.window <= 0:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.mark_durable(msg_id)
+            return msg_id
+
+    def rotate(self, first_id):
+        # called with the lock held: the old segment is made durable before it is closed
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.mark_durable(self.written)
+        self.segments.append(first_id)
+        self.file = open(os.path.join(self.root, segment_name(first_id)), 'ab', buffering=0)
+
+    def mark_durable(self, msg_id):
+        if msg_id > self.durable:
+            self.durable = msg_id
+            self.durable_cond.notify_all()
+
+    def sync(self):
+        # group commit: one flush + fsync for everything written so far
+        with self.lock:
+            if self.durable >= self.written:
+                return
+            self.file.flush()
+            upto = self.written
+            fd = os.dup(self.file.fileno())  # stays valid if append() rotates meanwhile
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.mark_durable(upto)
+
+    def wait_durable(self, msg_id, timeout=None):
+        with self.lock:
+            return self.durable_cond.wait_for(lambda: self.durable >= msg_id, timeout)
+
+    def work(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.sync()
+            except (OSError, ValueError) as e:
+                print(f"[MessageLog] fsync error: {e}")
+
+    # --------------------------------------------------------------------------
+    # Reading
+    # --------------------------------------------------------------------------
+    def read(self, after=0):
+        """Yield the logged records with id > after, oldest first."""
+        with self.lock:
+            self.file.flush()
+            segments = list(self.segments)
+            last = self.written
+        for i, first in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1] <= after + 1:
+                continue    # every id in this segment is <= after
+            records, valid = scan_segment(os.path.join(self.root, segment_name(first)))
+            for record in records:
+                if record["id"] > last:
+                    return
+                if record["id"] > after:
+                    yield record
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.mark_durable(self.written)
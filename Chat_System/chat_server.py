@@ -1,11 +1,24 @@
 import time
 import socket
 import select
+import selectors
 import sys
 import json
 import threading
-import pickle
+import heapq
 from chat_utils import *
+from chat_session import *
+from chat_codec import pick_codec, JSON
+from task_pool import TaskPool, PRIO_INTERACTIVE, PRIO_BATCH, AI_WORKERS, AI_QUEUE
+from task_pool import SEARCH_WORKERS, SEARCH_QUEUE
+from index_pipeline import IndexPipeline
+from message_store import MessageStore
+from indexer import SEARCH_LIMIT, add_stats
+from analyzer import ANALYZERS, DEFAULT_ANALYZER
+from segment_store import HistoryStore, HISTORY_DIR, HISTORY_BUDGET
+from chat_log import MessageLog, LOG_DIR, FSYNC_WINDOW
+from offline_queue import OfflineQueues, OFFLINE_DIR, OFFLINE_MAX, OFFLINE_TTL
+from group_history import GroupHistory, chat_group_id, room_id, HISTORY_PAGE, HISTORY_MAX_PAGE
 
 # === 引入辅助模块 ===
 try:
@@ -34,16 +47,6 @@ except ImportError:
 
     chat_group = type('obj', (object,), {'Group': Group})
 
-try:
-    from indexer import Indexer
-except ImportError:
-    class Indexer:
-        def __init__(self, name): self.name = name
-
-        def add_msg_and_index(self, msg): pass
-
-        def search(self, term): return []
-
 # === 引入 Bot Agent 的所有功能 ===
 from bot_agent import get_ai_response, generate_image_url, generate_summary, generate_keywords
 
@@ -69,122 +72,561 @@ class Sonnet:
 
 # ==============================================================================
 # Server class
+#   engine = "select"   : 原来的 select.select 循环 (legacy, 受 FD_SETSIZE 限制)
+#   engine = "selector" : selectors.DefaultSelector (Linux 上为 epoll),
+#                         每次唤醒只处理就绪的 socket, 代价与连接总数无关
 # ==============================================================================
+ENGINES = ("select", "selector")
+
+
+SERVER_TICK = 1.0   # 空闲时多久检查一次慢消费者
+LIST_PARAMS = ("cursor", "limit", "prefix", "state", "since")  # 任意一个出现即为结构化 list
+PRESENCE_TICK = 0.5        # presence 变化最多每 0.5 秒合并推送一次
+PRESENCE_MAX_DELTA = 500   # 单次推送的上限, 超过则让订阅者重新拉取 list
+ROOMS_FILE = "rooms.json"  # 命名聊天室的成员名单
+SEARCH_FRESH = True        # search 默认等待之前的消息建完索引 (read-your-writes)
+SEARCH_MAX_LIMIT = 200     # search 一次最多返回的条数
+LOG_REPLAY = 10000         # 启动时从消息日志重放最近多少条, 恢复各群组的聊天记录
+SUMMARY_CONTEXT = 50       # /summary 和 /keyword 分析最近多少条消息
+NLP_COMMANDS = ("/summary", "/keyword")  # 交给 NLP 处理, 不转发给其他人的消息
+
+
 class Server:
-    def __init__(self):
-        self.new_clients = []
+    def __init__(self, engine="select", backlog=socket.SOMAXCONN,
+                 high_water=OUT_HIGH_WATER, low_water=OUT_LOW_WATER,
+                 max_buffer=OUT_MAX_BUFFER, slow_timeout=SLOW_CONSUMER_TIMEOUT, max_frame=MAX_FRAME,
+                 ai_workers=AI_WORKERS, ai_queue=AI_QUEUE, rooms_file=ROOMS_FILE,
+                 search_fresh=SEARCH_FRESH, analyzer=DEFAULT_ANALYZER, history_dir=HISTORY_DIR,
+                 history_budget=HISTORY_BUDGET, log_dir=LOG_DIR, fsync_window=FSYNC_WINDOW,
+                 offline_dir=OFFLINE_DIR, offline_max=OFFLINE_MAX, offline_ttl=OFFLINE_TTL):
+        if engine not in ENGINES:
+            raise ValueError("unknown engine: " + str(engine))
+        self.engine = engine
+        self.selector = None
+        self.loop_thread = None
+        self.new_clients = set()
         self.logged_name2sock = {}
         self.logged_sock2name = {}
-        self.all_sockets = []
+        self.all_sockets = set()
         self.group = chat_group.Group()
+        self.rooms_file = rooms_file
+        self.group.load_rooms(rooms_file)
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind(SERVER)
-        self.server.listen(5)
-        self.all_sockets.append(self.server)
-        self.indices = {}
+        self.server.listen(backlog)
+        self.all_sockets.add(self.server)
+
+        # 每个连接一个 Session: 有界发送队列, 只由事件循环线程写 socket
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_buffer = max_buffer
+        self.slow_timeout = slow_timeout
+        self.max_frame = max_frame  # 客户端发来的单个帧的上限, 超过就断开
+        self.sessions = {}
+        self.write_waiting = set()  # 队列未发完, 需要等待可写事件的 socket
+        self.paused = set()  # 超过高水位, 暂停读取的 socket
+        self.dirty = set()  # 刚有数据入队, 等待本轮循环发送的 socket
+        self.dirty_lock = threading.Lock()
+        # worker 线程入队后通过 waker 唤醒事件循环
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+
+        # presence 订阅: sock -> 已推送到的 presence version
+        self.presence_subs = {}
+        # 所有订阅者都已推送到的版本 (最慢的那个); 等于当前版本时无事可做
+        self.presence_version = 0
+        self.presence_at = 0.0
+
+        # 所有消息只存一份、只建一次索引; 每个用户只记录自己能看到的消息 id
+        self.store = MessageStore(analyzer=analyzer)
+        # 消息索引交给后台线程批量完成, 不再占用投递路径
+        self.index_pipeline = IndexPipeline(self.store)
+        self.search_fresh = search_fresh
+        # 以前的会话: 磁盘上的分段索引, 第一次搜索时才载入, 按 LRU 控制在 history_budget MB 以内
+        self.history_store = HistoryStore(history_dir, analyzer, history_budget)
         self.sonnet = Sonnet()
 
-        # 用于存储群组聊天记录缓冲区，用于 NLP 分析
-        self.chat_history_buffer = {}
+        # bot_ask / NLP 任务共用的有界线程池, @bot 优先于 /summary
+        self.ai_pool = TaskPool(ai_workers, ai_queue)
+        # 搜索可能要从磁盘载入历史分段: 放在自己的线程池里, 不占索引线程和事件循环
+        self.search_pool = TaskPool(SEARCH_WORKERS, SEARCH_QUEUE, 'search-worker')
+
+        # 每个群组/聊天室最近的聊天记录 (定长环形缓冲区), 用于 NLP 分析和 history
+        self.group_history = GroupHistory()
+
+        # 每条消息投递前先写入磁盘上的消息日志 (fsync 按 fsync_window 秒批量提交)
+        self.log = MessageLog(log_dir, fsync_window)
+        self.replay_log()
+
+        # 离线用户: 聊天室消息只记一个读游标 (消息 id), 点对点的留言存磁盘队列; 登录时一次性批量送达
+        self.offline = OfflineQueues(offline_dir, offline_max, ttl=offline_ttl)
+
+    def replay_log(self):
+        # 重启后从日志恢复每个群组最近的聊天记录, /summary 和 history 不再从零开始
+        start = max(0, self.log.last_id - LOG_REPLAY)
+        self.group_history.floor = start
+        for record in self.log.read(start):
+            gid = record.get("group")
+            if gid is None:
+                continue
+            self.group_history.append(gid, record["id"], record["from"], record["message"], record["ts"])
+            # 新建的聊天群组编号接着日志里最大的往下排, 群组 id 不会和重启前的重复
+            if gid.startswith("g") and gid[1:].isdigit():
+                self.group.grp_ever = max(self.group.grp_ever, int(gid[1:]))
+
+    def group_id(self, name, room=None):
+        # 稳定的群组 id: 聊天室 "#名字", 聊天群组 "g编号", 不在群组里的用户 "@用户名"
+        if room is not None:
+            return room_id(room)
+        in_group, group_key = self.group.find_group(name)
+        return chat_group_id(group_key) if in_group else "@" + name
 
     def new_client(self, sock):
         print('new client...')
         sock.setblocking(0)
-        self.all_sockets.append(sock)
-        self.new_clients.append(sock)
+        self.all_sockets.add(sock)
+        self.new_clients.add(sock)
+        self.sessions[sock] = Session(sock, self.high_water, self.low_water, self.max_buffer, self.max_frame)
+        if self.selector is not None:
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def drop_socket(self, sock):
+        # 从两种引擎的监听集合中移除并关闭 socket
+        self.all_sockets.discard(sock)
+        self.new_clients.discard(sock)
+        self.sessions.pop(sock, None)
+        self.presence_subs.pop(sock, None)
+        self.write_waiting.discard(sock)
+        self.paused.discard(sock)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    # ==========================================================================
+    # Outbound path
+    # ==========================================================================
+    def send_to(self, sock, msg):
+        # 任何线程都可以调用: 只入队, 真正的 send 由事件循环完成
+        self.send_socks([sock], msg)
+
+    def broadcast(self, names, msg):
+        # 群发: 每种线路格式只序列化/加帧头一次, 同一个 bytes 交给每个接收者的发送队列
+        socks = []
+        for name in names:
+            sock = self.logged_name2sock.get(name)
+            if sock is not None:
+                socks.append(sock)
+        self.send_socks(socks, msg)
+
+    def send_socks(self, socks, msg):
+        sessions = [self.sessions.get(s) for s in socks]
+        sessions = [session for session in sessions if session is not None]
+        if not sessions:
+            return
+        fanout(sessions, msg)
+        with self.dirty_lock:
+            self.dirty.update(session.sock for session in sessions)
+        if threading.get_ident() != self.loop_thread:
+            self.wake()
+
+    def send_batch(self, sock, msgs):
+        # 多条消息各自编码/加帧头后拼成一块入队, 事件循环一次 send 发出
+        session = self.sessions.get(sock)
+        if session is None:
+            return
+        frames = []
+        for m in msgs:
+            try:
+                frames.append(session.frame(m))
+            except ValueError as e:
+                # 这个连接的线路格式装不下这条 (如 v1 帧头最多 5 位十进制): 只跳过这一条
+                print(f"[Server] message skipped for {self.logged_sock2name.get(sock)}: {e}")
+        if frames:
+            session.enqueue(b''.join(frames))
+        with self.dirty_lock:
+            self.dirty.add(sock)
+        if threading.get_ident() != self.loop_thread:
+            self.wake()
+
+    def room_backlog(self, name, cursor):
+        # 离线期间 name 所在聊天室的消息, [(ts, msg, bytes)]: 先从环形缓冲区取,
+        # 缓冲区里可能缺了的聊天室才扫一遍消息日志 (从游标开始)
+        entries = []
+        missing = set()
+        for room in self.group.rooms_of(name):
+            gid = room_id(room)
+            ring_entries, complete = self.group_history.since(gid, cursor)
+            if complete:
+                entries.extend((gid, entry) for entry in ring_entries)
+            else:
+                missing.add(gid)
+        if missing:
+            for record in self.log.read(cursor):
+                if record.get("group") in missing:
+                    entries.append((record["group"], (record["id"], record["from"], record["message"], record["ts"])))
+        backlog = []
+        for gid, (msg_id, sender, text, ts) in entries:
+            if sender == name or text.startswith(NLP_COMMANDS):
+                continue
+            msg = {"action": "exchange", "from": "[" + sender + "]", "message": text,
+                   "id": msg_id, "room": gid[1:]}
+            backlog.append((ts, msg, len(text) + 64))
+        return backlog
+
+    def backlog_depth(self):
+        # 所有离线用户在环形缓冲区里能看到的未读聊天室消息数 (metrics 用)
+        depth = 0
+        for name, cursor in self.offline.cursors.items():
+            for room in self.group.rooms_of(name):
+                depth += len(self.group_history.since(room_id(room), cursor)[0])
+        return depth
+
+    def known_user(self, name):
+        # 离线但来过的用户: 在某个聊天室里, 或者有历史记录/离线队列
+        if not valid_name(name):
+            return False
+        return bool(self.group.rooms_of(name)) or self.history_store.has_history(name) \
+            or self.offline.has_queue(name)
+
+    def wake(self):
+        try:
+            self.waker_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass  # 已经有未读的唤醒字节了
 
-    def login(self, sock):
+    def drain_waker(self):
         try:
-            msg = json.loads(myrecv(sock))
+            while self.waker_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def flush_dirty(self):
+        with self.dirty_lock:
+            dirty, self.dirty = self.dirty, set()
+        for sock in dirty:
+            self.flush(sock)
+
+    def flush(self, sock):
+        session = self.sessions.get(sock)
+        if session is None:
+            return
+        if session.evicted:
+            print('slow consumer evicted (buffer full)')
+            self.logout(sock)
+            return
+        try:
+            left = session.flush()
+        except OSError:
+            self.logout(sock)
+            return
+        if left > 0:
+            self.write_waiting.add(sock)
+        else:
+            self.write_waiting.discard(sock)
+        # 背压: 客户端读得太慢时先不再读它的请求, 排空到低水位后再恢复
+        if not session.paused and session.above_high_water():
+            session.pause()
+            self.paused.add(sock)
+        elif session.paused and session.below_low_water():
+            session.resume()
+            self.paused.discard(sock)
+        self.update_interest(sock)
+
+    def update_interest(self, sock):
+        if self.selector is None or sock not in self.sessions:
+            return
+        events = 0
+        if sock not in self.paused:
+            events |= selectors.EVENT_READ
+        if sock in self.write_waiting:
+            events |= selectors.EVENT_WRITE
+        try:
+            self.selector.modify(sock, events)
+        except (KeyError, ValueError):
+            pass
+
+    def evict_slow_consumers(self):
+        for sock in list(self.paused):
+            session = self.sessions.get(sock)
+            if session is not None and session.is_slow(self.slow_timeout):
+                print('slow consumer evicted (timeout)')
+                self.logout(sock)
+
+    def reply(self, sock, request, msg):
+        # 直接回复请求时带回客户端的 request id, 客户端据此匹配流水线上的请求
+        rid = request.get("rid")
+        if rid is not None:
+            msg["rid"] = rid
+        self.send_to(sock, msg)
+
+    # ==========================================================================
+    # Presence push
+    # ==========================================================================
+    def push_presence(self):
+        # 每个 tick 把这段时间内所有的 join/leave/connect/disconnect 合并成
+        # 一条增量推送; 同一起点版本的订阅者共享同一条消息 (只编码一次)
+        current = self.group.version
+        if not self.presence_subs or current == self.presence_version:
+            return
+        now = time.monotonic()
+        if now - self.presence_at < PRESENCE_TICK:
+            return
+        self.presence_at = now
+        by_version = {}
+        for sock, version in self.presence_subs.items():
+            # 积压中的订阅者先跳过, 它的版本不动, 下个 tick 再合并推送
+            if version < current and not self.sessions[sock].above_high_water():
+                by_version.setdefault(version, []).append(sock)
+        for version, socks in by_version.items():
+            delta = self.group.changes_since(version)
+            msg = {"action": "presence", "since": version, "version": current}
+            if delta is None or len(delta) > PRESENCE_MAX_DELTA:
+                msg["resync"] = True
+            else:
+                msg["delta"] = delta
+            self.send_socks(socks, msg)
+            for sock in socks:
+                self.presence_subs[sock] = current
+        # 被跳过的积压订阅者还停在旧版本: 只有全部追上才算推送完成, 否则下个 tick 继续
+        self.presence_version = min(self.presence_subs.values())
+
+    def save_rooms(self):
+        # 同一轮循环里的多次加入/退出只写一次文件
+        if self.group.rooms_dirty:
+            try:
+                self.group.save_rooms(self.rooms_file)
+            except OSError as e:
+                print(f"Cannot save rooms: {e}")
+                self.group.rooms_dirty = False
+
+    def save_offline(self):
+        try:
+            self.offline.save_cursors()
+        except OSError as e:
+            print(f"Cannot save offline cursors: {e}")
+            self.offline.cursors_dirty = False
+
+    def loop_timeout(self):
+        # 有待推送的 presence 变化时醒得早一点
+        if self.presence_subs and self.group.version != self.presence_version:
+            return PRESENCE_TICK
+        return SERVER_TICK
+
+    def list_structured(self, msg):
+        # 结构化的 who: 按名字分页 (cursor/limit), 可按前缀/状态过滤;
+        # 带 since 时只返回该版本之后变化过的成员
+        reply = {"action": "list", "version": self.group.version}
+        if "since" in msg:
+            delta = self.group.changes_since(int(msg["since"]))
+            if delta is None:
+                reply["resync"] = True  # 变更日志不够久, 客户端需要重新全量分页
+            else:
+                reply["delta"] = delta
+            return reply
+        users, cursor = self.group.list_page(msg.get("cursor"), msg.get("limit", chat_group.LIST_PAGE),
+                                             msg.get("prefix", ""), msg.get("state"))
+        reply["users"] = users
+        reply["next"] = cursor
+        return reply
+
+    def reply_admission(self, sock, position, sender, request):
+        # 线程池已满时明确告诉用户排在第几位 (或被拒绝), 而不是默默地堆线程
+        if position == 0:
+            return
+        if position < 0:
+            text = "AI assistant is busy, please try again later"
+        else:
+            text = f"AI assistant is busy, queued at position {position}"
+        if sender is None:
+            self.reply(sock, request, {"action": "bot_res", "status": "busy", "message": text})
+        else:
+            self.send_to(sock, {"action": "exchange", "from": sender, "message": text})
+
+    # ==========================================================================
+    # Inbound path
+    # ==========================================================================
+    def handle_readable(self, sock):
+        # 一次 recv_into 读入尽可能多的数据, 然后处理缓冲区里所有完整的帧
+        session = self.sessions.get(sock)
+        if session is None:
+            return
+        try:
+            n = session.decoder.feed_from(sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+        try:
+            for payload in session.decoder.frames():
+                if sock in self.logged_sock2name:
+                    self.handle_msg(sock, payload)
+                else:
+                    self.login(sock, payload)
+                if sock not in self.sessions:
+                    return  # logged out / dropped while handling the batch
+        except ValueError as e:
+            print(f"Bad frame: {e}")
+            n = 0
+        if n == 0:
+            if sock in self.logged_sock2name:
+                self.logout(sock)
+            else:
+                self.drop_socket(sock)
+
+    def login(self, sock, payload):
+        try:
+            msg = self.sessions[sock].codec.decode(payload)
             if len(msg) > 0:
                 if msg["action"] == "login":
                     name = msg["name"]
-                    if self.group.is_member(name) != True:
-                        self.new_clients.remove(sock)
+                    if not valid_name(name):
+                        # 用户名会成为服务器上的文件名, 拒绝 "..", 带 "/" 之类的名字
+                        self.send_to(sock, {"action": "login", "status": "bad_name"})
+                        print('bad user name rejected')
+                    elif self.group.is_member(name) != True:
+                        self.new_clients.discard(sock)
                         self.logged_name2sock[name] = sock
                         self.logged_sock2name[sock] = name
 
-                        if name not in self.indices.keys():
-                            try:
-                                self.indices[name] = Indexer(name)
-                            except:
-                                pass
+                        # 和消息排在同一个序列里: 登录之后提交的消息才算这次会话的
+                        self.index_pipeline.call(self.store.open_user, name)
 
                         print(name + ' logged in')
                         self.group.join(name)
-                        mysend(sock, json.dumps({"action": "login", "status": "ok"}))
+                        # 协议版本/编码协商: 回复仍用 v1 帧 + JSON, 之后双方切换到协商出的格式
+                        proto = max(PROTO_V1, min(int(msg.get("proto", PROTO_V1)), PROTO_MAX))
+                        codec = pick_codec(msg.get("codecs")) if proto >= PROTO_V2 else JSON
+                        compress = proto >= PROTO_V2 and msg.get("compress") == ZDICT_VERSION
+                        reply = {"action": "login", "status": "ok"}
+                        if proto > PROTO_V1:
+                            reply["proto"] = proto
+                        if codec is not JSON:
+                            reply["codec"] = codec.name
+                        if compress:
+                            reply["compress"] = ZDICT_VERSION
+                        self.send_to(sock, reply)
+                        self.sessions[sock].set_proto(proto)
+                        self.sessions[sock].set_codec(codec)
+                        self.sessions[sock].set_compress(compress)
+                        self.deliver_offline(sock, name)
                     else:
-                        mysend(sock, json.dumps({"action": "login", "status": "duplicate"}))
+                        self.send_to(sock, {"action": "login", "status": "duplicate"})
                         print(name + ' duplicate login attempt')
                 else:
                     print('wrong code received')
             else:
-                self.logout(sock)
+                self.drop_socket(sock)
         except Exception as e:
             print(f"Login Error: {e}")
-            self.all_sockets.remove(sock)
+            if sock in self.logged_sock2name:
+                # 已经登记过的用户要整个撤销, 否则名字一直占着, 以后登录都是 duplicate
+                self.logout(sock)
+            else:
+                self.drop_socket(sock)
+
+    def deliver_offline(self, sock, name):
+        # 登录已经成功: 补发出错只影响补发, 不能让登录半途而废
+        try:
+            cursor = self.offline.cursor(name)
+            backlog = self.room_backlog(name, cursor) if cursor is not None else ()
+            n = self.offline.drain(name, lambda msgs: self.send_batch(sock, msgs), backlog)
+            if n:
+                print(f"{name}: {n} offline messages delivered")
+        except Exception as e:
+            print(f"Cannot deliver offline messages to {name}: {e}")
+
+    def close_history(self, name):
+        # 在索引线程上执行 (持有 store 锁): 只把本次会话收到的消息交给历史记录,
+        # 追加 tail 和合并分段都在历史记录的后台线程做
+        self.history_store.append_later(name, self.store.close_user(name))
 
     def logout(self, sock):
         try:
             name = self.logged_sock2name[sock]
             try:
-                pickle.dump(self.indices[name], open(name + '.idx', 'wb'))
-            except:
-                pass
-            del self.indices[name]
+                # 排在登出前提交的消息之后关闭, 还没建好索引的消息也算进这次会话
+                self.index_pipeline.call(self.close_history, name)
+            except Exception as e:
+                print(f"Cannot save history of {name}: {e}")
             del self.logged_name2sock[name]
             del self.logged_sock2name[sock]
-            self.all_sockets.remove(sock)
             self.group.leave(name)
-            sock.close()
+            if self.group.rooms_of(name):
+                # 之后的聊天室消息下次登录时从这个 id 往后补发
+                self.offline.set_cursor(name, self.log.last_id)
         except:
             pass
+        self.drop_socket(sock)
 
-    def handle_msg(self, from_sock):
+    def handle_msg(self, from_sock, payload):
         try:
-            msg_str = myrecv(from_sock)
-            if len(msg_str) > 0:
-                msg = json.loads(msg_str)
+            if len(payload) > 0:
+                msg = self.sessions[from_sock].codec.decode(payload)
 
                 # --- CONNECT ---
                 if msg["action"] == "connect":
                     to_name = msg["target"]
                     from_name = self.logged_sock2name[from_sock]
                     if to_name == from_name:
-                        msg = json.dumps({"action": "connect", "status": "self"})
+                        response = {"action": "connect", "status": "self"}
                     elif self.group.is_member(to_name):
                         to_sock = self.logged_name2sock[to_name]
-                        self.group.connect(from_name, to_name)
+                        left_alone = self.group.connect(from_name, to_name)
                         the_guys = self.group.list_me(from_name)
-                        msg = json.dumps({"action": "connect", "status": "success"})
-                        for g in the_guys[1:]:
-                            to_sock = self.logged_name2sock[g]
-                            mysend(to_sock, json.dumps({"action": "connect", "status": "request", "from": from_name}))
+                        response = {"action": "connect", "status": "success"}
+                        self.broadcast(the_guys[1:],
+                                       {"action": "connect", "status": "request", "from": from_name})
+                        if left_alone is not None:
+                            # 换到新群之前的群里只剩他一个: 和主动 disconnect 一样通知他
+                            self.broadcast([left_alone], {"action": "disconnect"})
+                    elif self.known_user(to_name):
+                        # 对方不在线: 留言告诉他有人找过他
+                        self.offline.put([to_name], {"action": "exchange", "from": "[" + from_name + "]",
+                                                     "message": " wanted to chat with you"})
+                        response = {"action": "connect", "status": "offline"}
                     else:
-                        msg = json.dumps({"action": "connect", "status": "no-user"})
-                    mysend(from_sock, msg)
+                        response = {"action": "connect", "status": "no-user"}
+                    self.reply(from_sock, msg, response)
 
                 # --- EXCHANGE (主要聊天逻辑) ---
                 elif msg["action"] == "exchange":
                     from_name = self.logged_sock2name[from_sock]
-                    the_guys = self.group.list_me(from_name)
                     text_content = msg["message"]
+                    room = msg.get("room")
+                    # 发到命名聊天室的消息带上 room 字段, 接收方据此区分
+                    tag = {}
+                    if room is not None:
+                        if not self.group.in_room(from_name, room):
+                            self.reply(from_sock, msg, {"action": "exchange", "status": "not_member",
+                                                        "room": room})
+                            return
+                        the_guys = self.group.room_members(room)
+                        tag["room"] = room
+                    else:
+                        the_guys = self.group.list_me(from_name)
+                    gid = self.group_id(from_name, room)
 
-                    # [1. 记录聊天历史]
-                    group_key = tuple(sorted(the_guys))
-                    if group_key not in self.chat_history_buffer:
-                        self.chat_history_buffer[group_key] = []
-
-                    self.chat_history_buffer[group_key].append(f"{from_name}: {text_content}")
-                    if len(self.chat_history_buffer[group_key]) > 50:
-                        self.chat_history_buffer[group_key].pop(0)
+                    # [1. 记录聊天历史] 先写消息日志, 拿到单调递增的消息 id
+                    record = {"from": from_name, "message": text_content, "group": gid}
+                    msg_id = self.log.append(record)
+                    self.group_history.append(gid, msg_id, from_name, text_content, record["ts"])
 
                     # [2. NLP 指令检测]
-                    if text_content.startswith("/summary") or text_content.startswith("/keyword"):
+                    if text_content.startswith(NLP_COMMANDS):
                         print(f"[Server] NLP Processing for {from_name}...")
-                        history_text = "\n".join(self.chat_history_buffer.get(group_key, []))
+                        history_text = "\n".join(f"{sender}: {text}" for msg_id, sender, text, ts
+                                                 in self.group_history.recent(gid, SUMMARY_CONTEXT))
 
-                        def run_nlp_task(command, context_text, target_group):
+                        def run_nlp_task(command, context_text, target_group, tag):
                             try:
                                 result = ""
                                 prefix = ""
@@ -195,42 +637,36 @@ class Server:
                                     prefix = "[🔑 Key Topics]\n"
                                     result = generate_keywords(context_text)
 
-                                response = json.dumps({
+                                response = {
                                     "action": "exchange",
                                     "from": "[AI Assistant]",
                                     "message": prefix + result
-                                })
+                                }
+                                response.update(tag)
 
-                                for member in target_group:
-                                    if member in self.logged_name2sock:
-                                        sock = self.logged_name2sock[member]
-                                        mysend(sock, response)
+                                self.broadcast(target_group, response)
 
                                 print(f"[Server] NLP result sent to group.")
                             except Exception as e:
                                 print(f"[Server Error] NLP Task: {e}")
 
-                        t = threading.Thread(target=run_nlp_task, args=(text_content, history_text, the_guys))
-                        t.daemon = True
-                        t.start()
+                        position = self.ai_pool.submit(PRIO_BATCH, run_nlp_task, text_content, history_text, the_guys, tag)
+                        self.reply_admission(from_sock, position, "[AI Assistant]", msg)
 
                     else:
                         # [3. 普通消息转发 - 修复双重显示]
-                        for g in the_guys:
-                            # [关键修改] 如果 g 是发送者自己，跳过发送
-                            # 因为发送者的客户端已经本地回显了消息
-                            if g == from_name:
-                                continue
-
-                            to_sock = self.logged_name2sock[g]
-                            if g in self.indices:
-                                self.indices[g].add_msg_and_index(text_content)
-
-                            mysend(to_sock, json.dumps({
-                                "action": "exchange",
-                                "from": msg["from"],
-                                "message": text_content
-                            }))
+                        # [关键修改] 跳过发送者自己，因为发送者的客户端已经本地回显了消息
+                        recipients = [g for g in the_guys if g != from_name]
+                        self.index_pipeline.submit(text_content, recipients)
+
+                        response = {
+                            "action": "exchange",
+                            "from": msg["from"],
+                            "message": text_content,
+                            "id": msg_id
+                        }
+                        response.update(tag)
+                        self.broadcast(recipients, response)
 
                 # --- BOT ASK (AI 聊天/图片) ---
                 elif msg["action"] == "bot_ask":
@@ -243,16 +679,13 @@ class Server:
                     if in_group:
                         # 广播问题，但不发给提问者自己
                         people = self.group.list_me(from_name)
-                        for ppl in people:
-                            if ppl != from_name:
-                                to_sock = self.logged_name2sock[ppl]
-                                mysend(to_sock, json.dumps({
-                                    "action": "exchange",
-                                    "from": f"[{from_name}]",
-                                    "message": f"@bot {question}"
-                                }))
+                        self.broadcast([ppl for ppl in people if ppl != from_name], {
+                            "action": "exchange",
+                            "from": f"[{from_name}]",
+                            "message": f"@bot {question}"
+                        })
 
-                    def run_ai_task(sock, user, prompt, is_group):
+                    def run_ai_task(sock, user, prompt, is_group, request):
                         try:
                             if prompt.startswith("/aipic"):
                                 real_prompt = prompt[6:].strip()
@@ -262,55 +695,150 @@ class Server:
                                 reply = get_ai_response(user, prompt)
 
                             if is_group:
-                                response = json.dumps({
+                                response = {
                                     "action": "exchange",
                                     "from": "[AI Robot]",
                                     "message": reply
-                                })
-                                group_members = self.group.list_me(user)
-                                for g in group_members:
-                                    if g in self.logged_name2sock:
-                                        mysend(self.logged_name2sock[g], response)
+                                }
+                                self.broadcast(self.group.list_me(user), response)
                             else:
-                                response = json.dumps({
+                                response = {
                                     "action": "bot_res",
                                     "status": "success",
                                     "message": reply
-                                })
-                                mysend(sock, response)
+                                }
+                                self.reply(sock, request, response)
 
                         except Exception as e:
                             print(f"AI Task Error: {e}")
 
-                    t = threading.Thread(target=run_ai_task, args=(from_sock, from_name, question, in_group))
-                    t.daemon = True
-                    t.start()
+                    position = self.ai_pool.submit(PRIO_INTERACTIVE, run_ai_task, from_sock, from_name, question, in_group, msg)
+                    self.reply_admission(from_sock, position, "[AI Robot]" if in_group else None, msg)
 
                 # --- LIST ---
                 elif msg["action"] == "list":
-                    msg = self.group.list_all()
-                    mysend(from_sock, json.dumps({"action": "list", "results": msg}))
+                    if any(k in msg for k in LIST_PARAMS):
+                        self.reply(from_sock, msg, self.list_structured(msg))
+                    else:
+                        # 旧客户端: 整个 members / groups 字典的字符串
+                        results = self.group.list_all()
+                        self.reply(from_sock, msg, {"action": "list", "results": results})
+
+                # --- ROOMS ---
+                elif msg["action"] == "room_join":
+                    from_name = self.logged_sock2name[from_sock]
+                    room = msg.get("room")
+                    if not isinstance(room, str) or not 0 < len(room) <= chat_group.ROOM_NAME_MAX:
+                        response = {"action": "room_join", "status": "bad_name", "room": room}
+                    else:
+                        joined = self.group.join_room(from_name, room)
+                        response = {"action": "room_join", "status": "ok" if joined else "already",
+                                    "room": room, "members": len(self.group.room_members(room))}
+                    self.reply(from_sock, msg, response)
+
+                elif msg["action"] == "room_leave":
+                    from_name = self.logged_sock2name[from_sock]
+                    room = msg.get("room")
+                    left = self.group.leave_room(from_name, room)
+                    self.reply(from_sock, msg, {"action": "room_leave", "room": room,
+                                                "status": "ok" if left else "not_member"})
+
+                elif msg["action"] == "rooms":
+                    from_name = self.logged_sock2name[from_sock]
+                    results = [[room, len(self.group.room_members(room))]
+                               for room in self.group.rooms_of(from_name)]
+                    self.reply(from_sock, msg, {"action": "rooms", "results": results})
+
+                # --- HISTORY: 向前翻页的群组聊天记录 ---
+                elif msg["action"] == "history":
+                    # 不带 room 时是自己当前的聊天群组; before: 上一页返回的 next
+                    from_name = self.logged_sock2name[from_sock]
+                    room = msg.get("room")
+                    response = {"action": "history"}
+                    if room is not None:
+                        response["room"] = room
+                    if room is not None and not self.group.in_room(from_name, room):
+                        response["status"] = "not_member"
+                    else:
+                        limit = max(1, min(int(msg.get("limit", HISTORY_PAGE)), HISTORY_MAX_PAGE))
+                        before = msg.get("before")
+                        entries, cursor = self.group_history.page(self.group_id(from_name, room),
+                                                                  None if before is None else int(before), limit)
+                        response["status"] = "ok"
+                        response["results"] = [{"id": msg_id, "from": sender, "message": text, "ts": ts}
+                                               for msg_id, sender, text, ts in entries]
+                        response["next"] = cursor
+                    self.reply(from_sock, msg, response)
+
+                # --- METRICS ---
+                elif msg["action"] == "metrics":
+                    stats = self.offline.stats()
+                    stats["backlog"] = self.backlog_depth()
+                    self.reply(from_sock, msg, {"action": "metrics", "offline": stats})
+
+                # --- PRESENCE 订阅 ---
+                elif msg["action"] == "subscribe_presence":
+                    # since: 客户端手上名单的版本, 之后的变化都会推送给它
+                    version = min(int(msg.get("since", self.group.version)), self.group.version)
+                    self.presence_subs[from_sock] = version
+                    self.presence_version = min(self.presence_version, version)
+                    self.reply(from_sock, msg, {"action": "subscribe_presence", "status": "ok",
+                                                "version": version})
+
+                elif msg["action"] == "unsubscribe_presence":
+                    self.presence_subs.pop(from_sock, None)
+                    self.reply(from_sock, msg, {"action": "unsubscribe_presence", "status": "ok"})
 
                 # --- POEM ---
                 elif msg["action"] == "poem":
                     poem_indx = int(msg["target"])
                     poem = self.sonnet.get_poem(poem_indx)
                     poem = '\n'.join(poem).strip()
-                    mysend(from_sock, json.dumps({"action": "poem", "results": poem}))
+                    self.reply(from_sock, msg, {"action": "poem", "results": poem})
 
                 # --- TIME ---
                 elif msg["action"] == "time":
                     ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
-                    mysend(from_sock, json.dumps({"action": "time", "results": ctime}))
+                    self.reply(from_sock, msg, {"action": "time", "results": ctime})
 
                 # --- SEARCH ---
                 elif msg["action"] == "search":
                     term = msg["target"]
                     from_name = self.logged_sock2name[from_sock]
-                    search_rslt = ""
-                    if from_name in self.indices:
-                        search_rslt = '\n'.join([x[-1] for x in self.indices[from_name].search(term)])
-                    mysend(from_sock, json.dumps({"action": "search", "results": search_rslt}))
+                    # BM25 排序后只取 offset 开始的 limit 条, 再常见的词也不会返回成千上万行
+                    limit = max(1, min(int(msg.get("limit", SEARCH_LIMIT)), SEARCH_MAX_LIMIT))
+                    offset = max(0, int(msg.get("offset", 0)))
+
+                    def answer_search():
+                        # 本次会话 (内存) 和以前的会话 (磁盘分段) 各取前 offset + limit 条再合并;
+                        # 两边用同一组 N / df / avgdl 打分, 分数才能放在一起比较
+                        old_stats = self.history_store.query_stats(from_name, term)
+                        with self.index_pipeline.lock:
+                            stats = add_stats(self.store.query_stats(term), old_stats)
+                            total, hits = self.store.search_top_for(from_name, term, offset + limit, stats=stats)
+                        old_total, old_hits = self.history_store.search_top(from_name, term, offset + limit, stats=stats)
+                        total += old_total
+                        if old_hits:
+                            hits = [(score, 1, line, text) for score, line, text in hits]
+                            hits += [(score, 0, line, text) for score, line, text in old_hits]
+                            hits = heapq.nlargest(offset + limit, hits, key=lambda hit: hit[:3])
+                        hits = hits[offset:]
+                        response = {"action": "search", "results": '\n'.join([hit[-1] for hit in hits]),
+                                    "total": total,
+                                    "next": offset + limit if offset + limit < total else None}
+                        self.reply(from_sock, msg, response)
+
+                    def start_search():
+                        if self.search_pool.submit(PRIO_INTERACTIVE, answer_search) < 0:
+                            self.reply(from_sock, msg, {"action": "search", "status": "busy", "results": "",
+                                                        "total": 0, "next": None})
+
+                    # fresh: 等已投递的消息都进了索引再开始; 索引线程只负责等到这个序号,
+                    # 真正的搜索 (可能读磁盘) 在 search_pool 里做
+                    if msg.get("fresh", self.search_fresh):
+                        self.index_pipeline.after(self.index_pipeline.submitted, start_search)
+                    else:
+                        start_search()
 
                 # --- DISCONNECT ---
                 elif msg["action"] == "disconnect":
@@ -321,7 +849,7 @@ class Server:
                     if len(the_guys) == 1:
                         g = the_guys.pop()
                         to_sock = self.logged_name2sock[g]
-                        mysend(to_sock, json.dumps({"action": "disconnect"}))
+                        self.send_to(to_sock, {"action": "disconnect"})
             else:
                 self.logout(from_sock)
         except Exception as e:
@@ -329,22 +857,126 @@ class Server:
             self.logout(from_sock)
 
     def run(self):
-        print('starting server...')
+        print('starting server (engine: ' + self.engine + ')...')
+        self.loop_thread = threading.get_ident()
+        if self.engine == "selector":
+            self.run_selector()
+        else:
+            self.run_select()
+
+    def run_select(self):
+        while (1):
+            readers = [s for s in self.all_sockets if s not in self.paused]
+            readers.append(self.waker_r)
+            read, write, error = select.select(readers, list(self.write_waiting), [], self.loop_timeout())
+            for sock in write:
+                self.flush(sock)
+            for sock in read:
+                if sock is self.server:
+                    sock, address = self.server.accept()
+                    self.new_client(sock)
+                elif sock is self.waker_r:
+                    self.drain_waker()
+                else:
+                    self.handle_readable(sock)
+            self.push_presence()
+            self.flush_dirty()
+            self.evict_slow_consumers()
+            self.save_rooms()
+            self.save_offline()
+
+    def run_selector(self):
+        raise_nofile_limit()
+        self.selector = selectors.DefaultSelector()
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.waker_r, selectors.EVENT_READ)
         while (1):
-            read, write, error = select.select(self.all_sockets, [], [])
-            for logc in list(self.logged_name2sock.values()):
-                if logc in read:
-                    self.handle_msg(logc)
-            for newc in self.new_clients[:]:
-                if newc in read:
-                    self.login(newc)
-            if self.server in read:
+            for key, mask in self.selector.select(self.loop_timeout()):
+                sock = key.fileobj
+                if sock is self.server:
+                    self.accept_all()
+                elif sock is self.waker_r:
+                    self.drain_waker()
+                else:
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush(sock)
+                    if mask & selectors.EVENT_READ:
+                        self.handle_readable(sock)
+            self.push_presence()
+            self.flush_dirty()
+            self.evict_slow_consumers()
+            self.save_rooms()
+            self.save_offline()
+
+    def accept_all(self):
+        # 一次唤醒把 backlog 里排队的连接全部接进来, 应对登录风暴
+        while True:
+            try:
                 sock, address = self.server.accept()
-                self.new_client(sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.new_client(sock)
+
+
+def raise_nofile_limit():
+    # 数万个空闲连接需要足够的文件描述符, 尽量把软限制提到硬限制
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
 
 
 def main():
-    server = Server()
+    import argparse
+    parser = argparse.ArgumentParser(description='chat server argument')
+    parser.add_argument('--engine', type=str, default='select', choices=ENGINES,
+                        help='event loop engine: legacy select() or selectors (epoll/kqueue)')
+    parser.add_argument('--backlog', type=int, default=socket.SOMAXCONN, help='listen backlog')
+    parser.add_argument('--high-water', type=int, default=OUT_HIGH_WATER,
+                        help='outbound bytes above which a client stops being read')
+    parser.add_argument('--low-water', type=int, default=OUT_LOW_WATER,
+                        help='outbound bytes below which a paused client is read again')
+    parser.add_argument('--max-frame', type=int, default=MAX_FRAME,
+                        help='largest message, in bytes, a client may send; bigger ones drop the connection')
+    parser.add_argument('--max-buffer', type=int, default=OUT_MAX_BUFFER,
+                        help='outbound bytes above which a client is evicted')
+    parser.add_argument('--slow-timeout', type=float, default=SLOW_CONSUMER_TIMEOUT,
+                        help='seconds a client may stay above the high watermark')
+    parser.add_argument('--ai-workers', type=int, default=AI_WORKERS, help='concurrent AI requests')
+    parser.add_argument('--ai-queue', type=int, default=AI_QUEUE, help='AI requests allowed to wait')
+    parser.add_argument('--rooms-file', type=str, default=ROOMS_FILE, help='where named rooms are kept')
+    parser.add_argument('--stale-search', dest='search_fresh', action='store_false',
+                        help='answer searches without waiting for pending indexing')
+    parser.add_argument('--history-dir', type=str, default=HISTORY_DIR,
+                        help='where each user\'s message history is kept')
+    parser.add_argument('--history-budget', type=int, default=HISTORY_BUDGET,
+                        help='MB of message history kept in memory for searching')
+    parser.add_argument('--log-dir', type=str, default=LOG_DIR, help='where the message log is written')
+    parser.add_argument('--fsync-window', type=float, default=FSYNC_WINDOW,
+                        help='seconds of messages fsynced together (0: fsync every message)')
+    parser.add_argument('--offline-dir', type=str, default=OFFLINE_DIR,
+                        help='where messages for offline users wait')
+    parser.add_argument('--offline-max', type=int, default=OFFLINE_MAX,
+                        help='messages kept per offline user, oldest dropped first')
+    parser.add_argument('--offline-ttl', type=float, default=OFFLINE_TTL,
+                        help='seconds an offline message is kept')
+    parser.add_argument('--analyzer', type=str, default=DEFAULT_ANALYZER, choices=sorted(ANALYZERS),
+                        help='how messages and search queries are cut into terms')
+    args = parser.parse_args()
+
+    server = Server(engine=args.engine, backlog=args.backlog,
+                    high_water=args.high_water, low_water=args.low_water,
+                    max_buffer=args.max_buffer, slow_timeout=args.slow_timeout, max_frame=args.max_frame,
+                    ai_workers=args.ai_workers, ai_queue=args.ai_queue,
+                    rooms_file=args.rooms_file, search_fresh=args.search_fresh,
+                    analyzer=args.analyzer, history_dir=args.history_dir,
+                    history_budget=args.history_budget, log_dir=args.log_dir,
+                    fsync_window=args.fsync_window, offline_dir=args.offline_dir,
+                    offline_max=args.offline_max, offline_ttl=args.offline_ttl)
     server.run()
 
 
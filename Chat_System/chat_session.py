@@ -0,0 +1,130 @@
+"""
+Per-connection state kept by the server.
+
+Each logged-in (or logging-in) socket owns one Session. All outgoing
+frames are appended to the session's bounded outbound queue; only the
+server's event-loop thread ever calls sock.send(), so frames produced by
+the bot / NLP worker threads can no longer interleave on the wire.
+"""
+import collections
+import threading
+import time
+
+from chat_utils import frame_msg, FrameDecoder, PROTO_V1, MAX_FRAME
+from chat_codec import JSON
+
+# outbound buffer watermarks, in bytes
+OUT_HIGH_WATER = 256 * 1024     # stop reading requests from a client above this
+OUT_LOW_WATER = 64 * 1024       # resume reading once drained below this
+OUT_MAX_BUFFER = 4 * 1024 * 1024  # hard cap: evict the client beyond this
+SLOW_CONSUMER_TIMEOUT = 30.0    # seconds a client may stay above the high watermark
+
+
+class Session:
+    def __init__(self, sock, high_water=OUT_HIGH_WATER, low_water=OUT_LOW_WATER,
+                 max_buffer=OUT_MAX_BUFFER, max_frame=MAX_FRAME):
+        self.sock = sock
+        self.proto = PROTO_V1   # upgraded during login if the client asks for it
+        self.decoder = FrameDecoder(max_frame=max_frame)
+        self.codec = JSON   # likewise negotiated at login
+        self.compress = False
+        self.high_water = high_water
+        self.low_water = low_water
+        self.max_buffer = max_buffer
+        self.out = collections.deque()
+        self.out_bytes = 0
+        self.lock = threading.Lock()
+        self.paused = False
+        self.paused_at = 0.0
+        self.evicted = False
+
+    def set_proto(self, proto):
+        self.proto = proto
+        self.decoder.set_proto(proto)
+
+    def set_codec(self, codec):
+        self.codec = codec
+
+    def set_compress(self, compress):
+        self.compress = compress
+
+    def wire_format(self):
+        # sessions with the same wire format can share one encoded frame
+        return self.proto, self.codec.name, self.compress
+
+    def frame(self, msg):
+        return frame_msg(self.codec.encode(msg), self.proto, self.compress)
+
+    def enqueue(self, data):
+        # called from any thread; the same bytes object may be shared by
+        # many sessions, it is never copied here
+        with self.lock:
+            if self.evicted:
+                return False
+            if self.out_bytes + len(data) > self.max_buffer:
+                self.evicted = True
+                return False
+            self.out.append(data)
+            self.out_bytes += len(data)
+            return True
+
+    def flush(self):
+        # only ever called from the event-loop thread (the single writer).
+        # Sends until the queue is empty or the socket would block, and
+        # returns the number of bytes still buffered.
+        while True:
+            with self.lock:
+                if not self.out:
+                    return 0
+                chunk = self.out[0]
+            try:
+                sent = self.sock.send(chunk)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            with self.lock:
+                if sent == len(chunk):
+                    self.out.popleft()
+                elif sent > 0:
+                    self.out[0] = memoryview(chunk)[sent:]
+                self.out_bytes -= sent
+                if sent < len(chunk):
+                    return self.out_bytes
+
+    def pending(self):
+        return self.out_bytes
+
+    def above_high_water(self):
+        return self.out_bytes > self.high_water
+
+    def below_low_water(self):
+        return self.out_bytes <= self.low_water
+
+    def pause(self):
+        self.paused = True
+        self.paused_at = time.monotonic()
+
+    def resume(self):
+        self.paused = False
+
+    def is_slow(self, timeout=SLOW_CONSUMER_TIMEOUT):
+        return self.paused and time.monotonic() - self.paused_at > timeout
+
+
+def fanout(sessions, msg):
+    # queue msg (a dict) on every session: it is encoded and framed once per
+    # wire format in use, not once per recipient, and the same buffer is
+    # shared by all of them. A wire format that cannot carry msg (v1 frames
+    # hold at most 99 999 bytes) skips its own recipients, nobody else's.
+    frames = {}
+    queued = 0
+    for session in sessions:
+        key = session.wire_format()
+        if key not in frames:
+            try:
+                frames[key] = session.frame(msg)
+            except ValueError:
+                frames[key] = None
+        frame = frames[key]
+        if frame is not None and session.enqueue(frame):
+            queued += 1
+    return queued
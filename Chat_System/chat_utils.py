@@ -1,5 +1,7 @@
 import socket
+import struct
 import time
+import zlib
 
 # use local loop back address by default
 CHAT_IP = '127.0.0.1'
@@ -11,6 +13,27 @@ SERVER = (CHAT_IP, CHAT_PORT)
 
 menu = ('Please click the Commands button to see the basic functions')
 
+# user names come from clients and end up in file names on the server
+NAME_MAX = 64
+
+
+def valid_name(name):
+    return (isinstance(name, str) and 0 < len(name) <= NAME_MAX and not name.startswith('.')
+            and not any(c in name for c in '/\\\0'))
+
+
+def name_to_file(name):
+    # a file name that is safe whatever the user name: its UTF-8 bytes in hex
+    return name.encode('utf-8').hex()
+
+
+def file_to_name(stem):
+    # inverse of name_to_file; None for a file name it did not make
+    try:
+        return bytes.fromhex(stem).decode('utf-8')
+    except ValueError:
+        return None
+
 S_OFFLINE   = 0
 S_CONNECTED = 1
 S_LOGGEDIN  = 2
@@ -18,6 +41,50 @@ S_CHATTING  = 3
 
 SIZE_SPEC = 5
 
+# wire formats
+#   v1: 5 ASCII digits holding the payload length, then the UTF-8 payload
+#       (capped at 99,999 bytes)
+#   v2: 4-byte big-endian header, low 28 bits = payload length in bytes,
+#       high 4 bits reserved for per-frame flags. Negotiated at login.
+PROTO_V1 = 1
+PROTO_V2 = 2
+PROTO_MAX = PROTO_V2
+
+V2_HEADER = struct.Struct('!I')
+V2_FLAG_MASK = 0xF0000000
+V2_MAX_LEN = 0x0FFFFFFF
+FLAG_DEFLATE = 0x80000000   # payload is raw deflate, primed with ZDICT
+# largest payload accepted from the other end, before and after inflating:
+# the v2 length header is not trusted to size a buffer (it allows 256 MiB)
+MAX_FRAME = 1024 * 1024
+
+# per-frame compression (v2 only, negotiated at login): payloads of at
+# least COMPRESS_MIN bytes are deflated, and kept that way only if smaller.
+# ZDICT primes the compressor with tokens common in our traffic so that
+# short chat frames compress too; the most frequent ones go last, where
+# deflate can reach them most cheaply. Changing ZDICT means bumping
+# ZDICT_VERSION, since both ends must use identical bytes. The msgpack
+# keys are raw bytes: as str they would encode to UTF-8 (\xa6 -> c2 a6).
+ZDICT_VERSION = 2
+COMPRESS_MIN = 48
+COMPRESS_LEVEL = 6
+MAX_INFLATE = 64 * 1024 * 1024
+ZDICT = (''.join([
+    "Users: ------------\n", "Groups: -----------\n",
+    "Shall I compare thee to a summer's day? ", "IMAGE_URL:https://image.pollinations.ai/prompt/",
+    "[AI Assistant]", "[\U0001f4dd Chat Summary]\n", "[\U0001f511 Key Topics]\n",
+    "AI assistant is busy, queued at position ",
+    " would could should there their about which because really thanks please",
+    " what when where why how who yes no okay ok lol haha hello hi hey",
+    " thou thee thy thine doth hath love beauty time sweet",
+    " the and you that have for not with this but are was what can will",
+    " to of in is it be on at as so we my me your i I a",
+]).encode() + b"\xa6action\xa4from\xa7message\xa6status\xa7results\xa6target\xa7success" + ''.join([
+    '"bot_res", "search", "list", "poem", "time", "connect", "disconnect", ',
+    '{"action": "exchange", "from": "[AI Robot]", "message": "',
+    '"status": "success", "results": "", "target": "',
+]).encode())
+
 CHAT_WAIT = 0.2
 
 def print_state(state):
@@ -33,10 +100,36 @@ def print_state(state):
     else:
         print('Error: wrong state')
 
-def mysend(s, msg):
-    #append size to message and send it
-    msg = ('0' * SIZE_SPEC + str(len(msg)))[-SIZE_SPEC:] + str(msg)
-    msg = msg.encode()
+def deflate(body):
+    c = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=ZDICT)
+    return c.compress(body) + c.flush()
+
+def inflate(data, limit=MAX_INFLATE):
+    d = zlib.decompressobj(-15, zdict=ZDICT)
+    body = d.decompress(data, limit)
+    if d.unconsumed_tail:
+        raise ValueError('compressed frame too large')
+    return body
+
+def frame_msg(msg, proto=PROTO_V1, compress=False):
+    #append size to message and return the bytes to put on the wire
+    body = msg.encode() if isinstance(msg, str) else bytes(msg)
+    if proto == PROTO_V2:
+        flags = 0
+        if compress and len(body) >= COMPRESS_MIN:
+            packed = deflate(body)
+            if len(packed) < len(body):
+                body, flags = packed, FLAG_DEFLATE
+        if len(body) > V2_MAX_LEN:
+            raise ValueError('message too long')
+        return V2_HEADER.pack(flags | len(body)) + body
+    # v1 header counts bytes, not characters, so non-ASCII text frames correctly
+    if len(body) >= 10 ** SIZE_SPEC:
+        raise ValueError('message too long for v1 framing')
+    return ('0' * SIZE_SPEC + str(len(body)))[-SIZE_SPEC:].encode() + body
+
+def mysend(s, msg, proto=PROTO_V1, compress=False):
+    msg = frame_msg(msg, proto, compress)
     total_sent = 0
     while total_sent < len(msg) :
         sent = s.send(msg[total_sent:])
@@ -45,64 +138,164 @@ def mysend(s, msg):
             break
         total_sent += sent
 
-def myrecv(s):
-    #receive size first
-    '''
-    size = ''
-    while len(size) < SIZE_SPEC:
-        text = s.recv(SIZE_SPEC - len(size)).decode()
-        if not text:
+def recv_exact(s, size):
+    # fill a preallocated buffer in place instead of growing bytes with +=
+    buf = bytearray(size)
+    view = memoryview(buf)
+    got = 0
+    while got < size:
+        n = s.recv_into(view[got:], size - got)
+        if n == 0:
             print('disconnected')
-            return('')
-        size += text
-    size = int(size)
-    '''
-    size_data = b''
-    while len(size_data) < SIZE_SPEC:
-        text = s.recv(SIZE_SPEC - len(size_data))
-        if not text:
-            print('disconnected')
-            return ('')
-        size_data += text
-    try:
-        # 先解码长度头，再转int
-        size = int(size_data.decode())
-    except ValueError:
-        print('Invalid header received')
-        return ''
+            return None
+        got += n
+    return buf
 
-    #now receive message
-    '''
-    msg = ''
-    while len(msg) < size:
-        text = s.recv(size-len(msg)).decode()
-        #修正：应该判断 if text == '': 或者 if not text:。
-        if text == '':
-            print('disconnected')
-            break
-        msg += text
-    #print ('received '+message)
-    return (msg)
-    '''
-    # 2. 接收消息体
-    msg_b = b''
-    while len(msg_b) < size:
-        # 注意：这里只接收 bytes，不 decode
-        chunk = s.recv(size - len(msg_b))
-        if not chunk:
-            print('disconnected')
-            return ''  # 或者抛出异常，取决于你的上层逻辑
-        msg_b += chunk
+def myrecv(s, proto=PROTO_V1, max_frame=MAX_FRAME):
+    #receive size first
+    header = recv_exact(s, V2_HEADER.size if proto == PROTO_V2 else SIZE_SPEC)
+    if header is None:
+        return ''
+    flags = 0
+    if proto == PROTO_V2:
+        size = V2_HEADER.unpack(header)[0]
+        flags, size = size & V2_FLAG_MASK, size & V2_MAX_LEN
+    else:
+        try:
+            # 先解码长度头，再转int
+            size = int(header.decode())
+        except ValueError:
+            print('Invalid header received')
+            return ''
+    if size > max_frame:
+        print('Frame too large')
+        return ''
 
-    # 3. 接收完毕后，一次性解码
+    # 2. 接收消息体, 接收完毕后一次性解码
+    body = recv_exact(s, size)
+    if body is None:
+        return ''
     try:
-        msg = msg_b.decode()
-    except UnicodeDecodeError:
+        if flags & FLAG_DEFLATE:
+            body = inflate(body, max_frame)
+        msg = body.decode()
+    except (UnicodeDecodeError, ValueError, zlib.error):
         print('Decoding error')
         return ''
 
     return msg
 
+RECV_CHUNK = 16 * 1024
+
+class FrameDecoder:
+    '''
+    Incremental decoder for a stream of frames.
+
+    feed_from() does one large recv_into() into a reusable buffer, and
+    next_frame() / frames() then hand back every complete frame already
+    buffered, so a burst of pipelined messages costs one syscall instead
+    of two per message. Consumed bytes are compacted away lazily; the
+    buffer is allocated on first use, grows only when a single frame does
+    not fit, and shrinks back once such a frame has been consumed. A frame
+    announcing more than max_frame bytes raises ValueError before any
+    room is made for it.
+    '''
+    def __init__(self, proto=PROTO_V1, max_frame=MAX_FRAME):
+        self.proto = proto
+        self.max_frame = max_frame
+        self.buf = bytearray()
+        self.start = 0  # first unconsumed byte
+        self.end = 0    # one past the last received byte
+
+    def set_proto(self, proto):
+        # takes effect from the next frame on, bytes already buffered included
+        self.proto = proto
+
+    def buffered(self):
+        return self.end - self.start
+
+    def reserve(self, need):
+        # make room for `need` more bytes after self.end
+        if len(self.buf) - self.end >= need:
+            return
+        pending = self.end - self.start
+        if self.start > 0:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        if len(self.buf) - self.end < need:
+            grow = max(need - (len(self.buf) - self.end), len(self.buf), RECV_CHUNK)
+            self.buf.extend(bytes(grow))
+
+    def feed_from(self, s):
+        # one recv_into(); returns the number of bytes read, 0 on EOF.
+        # BlockingIOError is left to the caller on non-blocking sockets.
+        self.reserve(min(RECV_CHUNK, max(len(self.buf) - self.buffered(), 1)))
+        view = memoryview(self.buf)
+        try:
+            n = s.recv_into(view[self.end:])
+        finally:
+            view.release()
+        self.end += n
+        return n
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.buf[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self):
+        # return the payload of the next complete frame, or None
+        avail = self.end - self.start
+        flags = 0
+        if self.proto == PROTO_V2:
+            hsize = V2_HEADER.size
+            if avail < hsize:
+                return None
+            size = V2_HEADER.unpack_from(self.buf, self.start)[0]
+            flags, size = size & V2_FLAG_MASK, size & V2_MAX_LEN
+        else:
+            hsize = SIZE_SPEC
+            if avail < hsize:
+                return None
+            size = int(self.buf[self.start:self.start + hsize])
+        if size > self.max_frame:
+            raise ValueError('frame of %d bytes exceeds the %d byte limit' % (size, self.max_frame))
+        if avail < hsize + size:
+            # make sure a large frame will fit once the rest arrives
+            self.reserve(hsize + size - avail)
+            return None
+        body_at = self.start + hsize
+        payload = bytes(self.buf[body_at:body_at + size])
+        self.start = body_at + size
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buf) > RECV_CHUNK:
+                self.buf = bytearray(RECV_CHUNK)
+        if flags & FLAG_DEFLATE:
+            try:
+                payload = inflate(payload, self.max_frame)
+            except zlib.error as e:
+                raise ValueError('bad compressed frame: %s' % e)
+        return payload
+
+    def frames(self):
+        # yield every complete frame currently buffered
+        while True:
+            payload = self.next_frame()
+            if payload is None:
+                return
+            yield payload
+
+    def recv(self, s):
+        # blocking helper: next frame's payload, b'' when the peer is gone
+        while True:
+            payload = self.next_frame()
+            if payload is not None:
+                return payload
+            if self.feed_from(s) == 0:
+                print('disconnected')
+                return b''
+
 def text_proc(text, user):
     ctime = time.strftime('%d.%m.%y,%H:%M', time.localtime())
     return('(' + ctime + ') ' + user + ' : ' + text) # message goes directly to screen
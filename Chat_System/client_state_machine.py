@@ -4,15 +4,39 @@ Created on Sun Apr  5 00:00:32 2015
 @author: zhengzhang
 """
 from chat_utils import *
-import json
+from chat_codec import JSON
+from chat_group import LIST_PAGE
+import collections
+import itertools
 
 class ClientSM:
-    def __init__(self, s):
+    def __init__(self, s, decoder=None):
         self.state = S_OFFLINE
         self.peer = ''
         self.me = ''
         self.out_msg = ''
         self.s = s
+        self.proto = PROTO_V1
+        self.codec = JSON
+        self.compress = False
+        # shared with the Client, so frames it has already buffered are not lost
+        self.decoder = decoder if decoder is not None else FrameDecoder()
+        # outstanding requests: rid -> (action, callback). Replies are matched
+        # by the rid the server echoes back, so queries can be pipelined and
+        # nothing ever blocks waiting for a particular reply.
+        self.rids = itertools.count(1)
+        self.pending = collections.OrderedDict()
+        # local copy of the user list, kept fresh with "since version" deltas
+        self.roster = {}
+        self.roster_version = None
+        self.roster_paging = None
+        # once the roster is loaded the server pushes presence changes to us,
+        # so 'who' can answer from the local copy
+        self.presence = False
+        # scrolling back through a room's history: the room, and the cursor
+        # of the next older page (None once there is nothing older)
+        self.history_room = None
+        self.history_next = None
 
     def set_state(self, state):
         self.state = state
@@ -29,30 +53,250 @@ class ClientSM:
     def get_instructions(self):
         return menu
 
+    def set_proto(self, proto):
+        self.proto = proto
+        self.decoder.set_proto(proto)
+
+    def set_codec(self, codec):
+        self.codec = codec
+
+    def set_compress(self, compress):
+        self.compress = compress
+
+    def send(self, msg):
+        mysend(self.s, self.codec.encode(msg), self.proto, self.compress)
+
+    def recv(self):
+        return self.codec.decode(self.decoder.recv(self.s))
+
+    def request(self, msg, callback):
+        rid = next(self.rids)
+        msg["rid"] = rid
+        self.pending[rid] = (msg["action"], callback)
+        self.send(msg)
+        return rid
+
+    def dispatch(self, msg):
+        # run the callback of the request msg answers; False if it answers none
+        rid = msg.get("rid")
+        if rid is None:
+            # an older server does not echo rids: replies come back in order,
+            # so hand it to the oldest pending request of the same action
+            if msg.get("status") == "request":
+                return False  # a peer connecting to us, not a reply
+            for pending_rid, (action, callback) in self.pending.items():
+                if action == msg.get("action"):
+                    rid = pending_rid
+                    break
+        entry = self.pending.pop(rid, None)
+        if entry is None:
+            return False
+        entry[1](msg)
+        return True
+
     def connect_to(self, peer):
-        msg = json.dumps({"action":"connect", "target":peer})
-        mysend(self.s, msg)
-        response = json.loads(myrecv(self.s))
+        msg = {"action":"connect", "target":peer}
+        self.request(msg, lambda response: self.on_connect(peer, response))
+
+    def reset_history(self):
+        # a new chat group: plain 'history' starts again from its latest messages
+        self.history_room = None
+        self.history_next = None
+
+    def on_connect(self, peer, response):
         if response["status"] == "success":
             self.peer = peer
+            self.reset_history()
             self.out_msg += 'You are connected with '+ self.peer + '\n'
-            return (True)
+            self.state = S_CHATTING
+            self.out_msg += 'Connect to ' + peer + '. Chat away!\n\n'
+            self.out_msg += '-----------------------------------\n'
+            return
         elif response["status"] == "busy":
             self.out_msg += 'User is busy. Please try again later\n'
         elif response["status"] == "self":
             self.out_msg += 'Cannot talk to yourself (sick)\n'
+        elif response["status"] == "offline":
+            self.out_msg += peer + ' is offline and will see that you called\n'
         else:
             self.out_msg += 'User is not online, try again later\n'
-        return(False)
+        self.out_msg += 'Connection unsuccessful\n'
+
+    def on_time(self, response):
+        self.out_msg += "Time is: " + response["results"]
+
+    def who(self, prefix=''):
+        if prefix:
+            self.request({"action":"list", "prefix":prefix, "limit":LIST_PAGE}, self.on_list_prefix)
+        elif self.presence and self.roster_version is not None:
+            self.show_roster(self.roster.items())
+        elif self.roster_version is None:
+            self.roster = {}
+            self.request({"action":"list", "limit":LIST_PAGE}, self.on_list)
+        else:
+            self.request({"action":"list", "since":self.roster_version}, self.on_list)
+
+    def on_list(self, response):
+        if "results" in response:
+            # an older server sends the whole listing as one string
+            self.out_msg += 'Here are all the users in the system:\n'
+            self.out_msg += response["results"]
+        elif response.get("resync"):
+            self.roster_version = None
+            self.who()
+        elif "delta" in response:
+            self.apply_delta(response)
+            self.show_roster(self.roster.items())
+        else:
+            # one page of the full listing. Keep the version of the first
+            # page, so the next delta also covers changes made while paging
+            if self.roster_paging is None:
+                self.roster_paging = response["version"]
+            self.roster.update((name, (state, g)) for name, state, g in response["users"])
+            if response["next"]:
+                self.request({"action":"list", "limit":LIST_PAGE, "cursor":response["next"]}, self.on_list)
+            else:
+                self.roster_version, self.roster_paging = self.roster_paging, None
+                self.show_roster(self.roster.items())
+                self.subscribe_presence()
+
+    def apply_delta(self, response):
+        # entries carry the absolute state, so applying one twice is harmless
+        for name, state, group_key in response["delta"]:
+            if state is None:
+                self.roster.pop(name, None)
+            else:
+                self.roster[name] = (state, group_key)
+        self.roster_version = response["version"]
+
+    def subscribe_presence(self):
+        self.request({"action":"subscribe_presence", "since":self.roster_version},
+                     self.on_subscribe_presence)
+
+    def on_subscribe_presence(self, response):
+        # an older server never answers, so we just keep polling with 'who'
+        self.presence = response.get("status") == "ok"
+
+    def on_presence(self, msg):
+        # pushed by the server, merged silently into the local roster
+        if self.roster_version is None:
+            return
+        if msg.get("resync"):
+            self.roster_version = None  # too far behind: reload on next 'who'
+        else:
+            self.apply_delta(msg)
+
+    def on_list_prefix(self, response):
+        if "results" in response:
+            self.out_msg += 'Here are all the users in the system:\n'
+            self.out_msg += response["results"]
+            return
+        self.show_roster((name, (state, g)) for name, state, g in response["users"])
+        if response["next"]:
+            self.out_msg += '...\n'
+
+    def show_roster(self, users):
+        self.out_msg += 'Here are all the users in the system:\n'
+        for name, (state, group_key) in sorted(users):
+            self.out_msg += name + ': ' + state
+            if group_key:
+                self.out_msg += ' (group ' + str(group_key) + ')'
+            self.out_msg += '\n'
+
+    def on_room(self, response):
+        # answers to join / leave, and the refusal of a room message
+        room = str(response.get("room"))
+        status = response.get("status")
+        if response["action"] == "room_join" and status in ("ok", "already"):
+            self.out_msg += 'In room #' + room + ' (' + str(response["members"]) + ' members)\n'
+        elif response["action"] == "room_leave" and status == "ok":
+            self.out_msg += 'Left room #' + room + '\n'
+        elif status == "bad_name":
+            self.out_msg += 'Bad room name\n'
+        else:
+            self.out_msg += 'You are not in room #' + room + '\n'
+
+    def on_rooms(self, response):
+        if not response["results"]:
+            self.out_msg += 'You are not in any room\n'
+        for room, count in response["results"]:
+            self.out_msg += '#' + room + ': ' + str(count) + ' members\n'
+
+    def history(self, room=None):
+        # 'history #room' shows the latest messages of the room; plain
+        # 'history' the page before the one shown, or once there is none,
+        # the latest messages of our current chat group
+        msg = {"action":"history"}
+        if room is not None:
+            self.history_room = room
+        elif self.history_next is not None:
+            msg["before"] = self.history_next
+        else:
+            self.history_room = None
+        if self.history_room:
+            msg["room"] = self.history_room
+        self.request(msg, self.on_history)
+
+    def on_history(self, response):
+        if response.get("status") != "ok":
+            self.out_msg += 'You are not in room #' + str(response.get("room")) + '\n'
+            self.history_next = None
+            return
+        if not response["results"]:
+            self.out_msg += 'No more messages\n'
+        for entry in response["results"]:
+            self.out_msg += '[' + entry["from"] + '] ' + entry["message"] + '\n'
+        self.history_next = response.get("next")
+        if self.history_next is not None:
+            self.out_msg += '(\'history\' for older messages)\n'
+
+    def on_search(self, term, response):
+        if response.get("status") == "busy":
+            self.out_msg += 'Too many searches running, try again later\n\n'
+            return
+        search_rslt = response["results"].strip()
+        if (len(search_rslt)) > 0:
+            self.out_msg += search_rslt + '\n'
+            if response.get("next") is not None:
+                # the server ranks the hits and only sends the best ones
+                shown = len(search_rslt.split('\n'))
+                self.out_msg += '(best ' + str(shown) + ' of ' + str(response["total"]) + ' matches)\n'
+            self.out_msg += '\n'
+        else:
+            self.out_msg += '\'' + term + '\'' + ' not found\n\n'
+
+    def on_poem(self, poem_idx, response):
+        poem = response["results"]
+        if (len(poem) > 0):
+            self.out_msg += poem + '\n\n'
+        else:
+            self.out_msg += 'Sonnet ' + poem_idx + ' not found\n\n'
 
     def disconnect(self):
-        msg = json.dumps({"action":"disconnect"})
-        mysend(self.s, msg)
+        msg = {"action":"disconnect"}
+        self.send(msg)
         self.out_msg += 'You are disconnected from ' + self.peer + '\n'
         self.peer = ''
 
     def proc(self, my_msg, peer_msg):
         self.out_msg = ''
+        # replies to our own requests are handled first, whatever the state
+        if len(peer_msg) > 0 and self.dispatch(peer_msg):
+            peer_msg = ''
+        elif len(peer_msg) > 0 and peer_msg["action"] == "presence":
+            self.on_presence(peer_msg)
+            peer_msg = ''
+        elif len(peer_msg) > 0 and "offline" in peer_msg and "room" not in peer_msg:
+            # queued for us while we were offline
+            self.out_msg += '(while you were away) ' + peer_msg["from"] + peer_msg["message"] + '\n'
+            peer_msg = ''
+        elif len(peer_msg) > 0 and "room" in peer_msg:
+            # room traffic is shown whatever we are doing
+            if "status" in peer_msg:
+                self.on_room(peer_msg)  # our message was refused
+            else:
+                self.out_msg += '#' + peer_msg["room"] + ' ' + peer_msg["from"] + peer_msg["message"] + '\n'
+            peer_msg = ''
 #==============================================================================
 # Once logged in, do a few things: get peer listing, connect, search
 # And, of course, if you are so bored, just go
@@ -67,52 +311,58 @@ class ClientSM:
                     self.state = S_OFFLINE
 
                 elif my_msg == 'time':
-                    mysend(self.s, json.dumps({"action":"time"}))
-                    time_in = json.loads(myrecv(self.s))["results"]
-                    self.out_msg += "Time is: " + time_in
+                    self.request({"action":"time"}, self.on_time)
 
                 elif my_msg == 'who':
-                    mysend(self.s, json.dumps({"action":"list"}))
-                    logged_in = json.loads(myrecv(self.s))["results"]
-                    self.out_msg += 'Here are all the users in the system:\n'
-                    self.out_msg += logged_in
+                    self.who()
+
+                elif my_msg.startswith('who '):
+                    self.who(my_msg[4:].strip())
+
+                elif my_msg.startswith('join '):
+                    room = my_msg[5:].strip()
+                    self.request({"action":"room_join", "room":room}, self.on_room)
+
+                elif my_msg.startswith('leave '):
+                    room = my_msg[6:].strip()
+                    self.request({"action":"room_leave", "room":room}, self.on_room)
+
+                elif my_msg == 'rooms':
+                    self.request({"action":"rooms"}, self.on_rooms)
+
+                elif my_msg.startswith('history #'):
+                    self.history(my_msg[9:].strip())
+
+                elif my_msg == 'history':
+                    self.history()
+
+                elif my_msg[0] == '#' and ' ' in my_msg:
+                    room, text = my_msg[1:].split(' ', 1)
+                    self.send({"action":"exchange", "from":"[" + self.me + "]",
+                               "room":room, "message":text})
 
                 elif my_msg[0] == 'c':
                     peer = my_msg[1:]
                     peer = peer.strip()
-                    if self.connect_to(peer) == True:
-                        self.state = S_CHATTING
-                        self.out_msg += 'Connect to ' + peer + '. Chat away!\n\n'
-                        self.out_msg += '-----------------------------------\n'
-                    else:
-                        self.out_msg += 'Connection unsuccessful\n'
+                    self.connect_to(peer)
 
                 elif my_msg[0] == '?':
                     term = my_msg[1:].strip()
-                    mysend(self.s, json.dumps({"action":"search", "target":term}))
-                    search_rslt = json.loads(myrecv(self.s))["results"].strip()
-                    if (len(search_rslt)) > 0:
-                        self.out_msg += search_rslt + '\n\n'
-                    else:
-                        self.out_msg += '\'' + term + '\'' + ' not found\n\n'
+                    self.request({"action":"search", "target":term},
+                                 lambda response: self.on_search(term, response))
 
                 elif my_msg[0] == 'p' and my_msg[2:].isdigit():
                     poem_idx = my_msg[1:].strip()
-                    mysend(self.s, json.dumps({"action":"poem", "target":poem_idx}))
-                    poem = json.loads(myrecv(self.s))["results"]
-                    # print(poem)
-                    if (len(poem) > 0):
-                        self.out_msg += poem + '\n\n'
-                    else:
-                        self.out_msg += 'Sonnet ' + poem_idx + ' not found\n\n'
+                    self.request({"action":"poem", "target":poem_idx},
+                                 lambda response: self.on_poem(poem_idx, response))
 
                 else:
                     self.out_msg += menu
 
             if len(peer_msg) > 0:
-                peer_msg = json.loads(peer_msg)
                 if peer_msg["action"] == "connect":
                     self.peer = peer_msg["from"]
+                    self.reset_history()
                     self.out_msg += 'Request from ' + self.peer + '\n'
                     self.out_msg += 'You are connected with ' + self.peer
                     self.out_msg += '. Chat away!\n\n'
@@ -125,16 +375,23 @@ class ClientSM:
 #==============================================================================
         elif self.state == S_CHATTING:
             if len(my_msg) > 0:     # my stuff going out
-                mysend(self.s, json.dumps({"action":"exchange", "from":"[" + self.me + "]", "message":my_msg}))
+                # history of this group (or a room) without leaving the chat
+                if my_msg.startswith('history #'):
+                    self.history(my_msg[9:].strip())
+                elif my_msg == 'history':
+                    self.history()
+                else:
+                    self.send({"action":"exchange", "from":"[" + self.me + "]", "message":my_msg})
                 if my_msg == 'bye':
                     self.disconnect()
+                    self.reset_history()
                     self.state = S_LOGGEDIN
                     self.peer = ''
             if len(peer_msg) > 0:    # peer's stuff, coming in
-                peer_msg = json.loads(peer_msg)
                 if peer_msg["action"] == "connect":
                     self.out_msg += "(" + peer_msg["from"] + " joined)\n"
                 elif peer_msg["action"] == "disconnect":
+                    self.reset_history()
                     self.state = S_LOGGEDIN
                 else:
                     self.out_msg += peer_msg["from"] + peer_msg["message"]
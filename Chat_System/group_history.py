@@ -0,0 +1,121 @@
+"""
+Recent messages of every chat group and room, for /summary and for the
+"history" action.
+
+Each group has a fixed-capacity ring buffer of (id, from, message, ts)
+entries, keyed by a stable group id: "g<n>" for a chat group (its key in
+chat_group), "#<name>" for a room. Appending is O(1) and overwrites the
+oldest entry once the ring is full. Message ids come from the message log
+and only grow, so the entries of a ring are sorted by id and a page
+"before id" is found by binary search.
+
+At most GROUP_MAX rings are kept; the least recently written one is dropped
+first (its messages remain in the message log). Each ring remembers its
+floor, the newest id it may have lost (overwritten, dropped, or never
+replayed into it), so since() can tell whether the ring alone has every
+message after a given id or the log must be read.
+"""
+import collections
+
+RING_CAPACITY = 500     # messages kept per group
+GROUP_MAX = 10000       # groups with a ring
+HISTORY_PAGE = 50       # default page size of the history action
+HISTORY_MAX_PAGE = 200
+
+
+def chat_group_id(group_key):
+    return "g%d" % group_key
+
+
+def room_id(room):
+    return "#" + room
+
+
+class Ring:
+    __slots__ = ('items', 'start', 'capacity', 'floor')
+
+    def __init__(self, capacity=RING_CAPACITY, floor=0):
+        self.items = []
+        self.start = 0          # index of the oldest item once the ring is full
+        self.capacity = capacity
+        self.floor = floor      # messages with ids up to this may be missing
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        # i-th oldest item
+        return self.items[(self.start + i) % len(self.items)]
+
+    def append(self, item):
+        if len(self.items) < self.capacity:
+            self.items.append(item)
+        else:
+            self.floor = self.items[self.start][0]
+            self.items[self.start] = item
+            self.start = (self.start + 1) % self.capacity
+
+    def last(self, n):
+        n = min(n, len(self.items))
+        return [self[i] for i in range(len(self.items) - n, len(self.items))]
+
+    def count_before(self, msg_id):
+        # how many items have an id below msg_id
+        lo, hi = 0, len(self.items)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] < msg_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class GroupHistory:
+    def __init__(self, capacity=RING_CAPACITY, max_groups=GROUP_MAX):
+        self.capacity = capacity
+        self.max_groups = max_groups
+        self.rings = collections.OrderedDict()    # group id -> Ring, least recently written first
+        # ids up to this may be missing from groups without a ring: raised
+        # by the log replay at startup and when a ring is dropped
+        self.floor = 0
+
+    def append(self, gid, msg_id, sender, message, ts):
+        ring = self.rings.get(gid)
+        if ring is None:
+            ring = self.rings[gid] = Ring(self.capacity, self.floor)
+            if len(self.rings) > self.max_groups:
+                dropped = self.rings.popitem(last=False)[1]
+                self.floor = max(self.floor, dropped.last(1)[0][0])
+        else:
+            self.rings.move_to_end(gid)
+        ring.append((msg_id, sender, message, ts))
+
+    def recent(self, gid, n):
+        ring = self.rings.get(gid)
+        return ring.last(n) if ring is not None else []
+
+    def since(self, gid, after):
+        """
+        (entries with id > after, oldest first, complete): complete is False
+        when some of them may only be left in the message log.
+        """
+        ring = self.rings.get(gid)
+        if ring is None:
+            return [], after >= self.floor
+        entries = [ring[i] for i in range(ring.count_before(after + 1), len(ring))]
+        return entries, after >= ring.floor
+
+    def page(self, gid, before=None, limit=HISTORY_PAGE):
+        """
+        Up to limit entries older than message id `before` (the newest ones if
+        None), oldest first, and the cursor for the next older page: the id
+        of the oldest entry returned, or None when the ring has no more.
+        """
+        ring = self.rings.get(gid)
+        if ring is None:
+            return [], None
+        end = len(ring) if before is None else ring.count_before(before)
+        begin = max(0, end - limit)
+        entries = [ring[i] for i in range(begin, end)]
+        return entries, (entries[0][0] if begin > 0 else None)
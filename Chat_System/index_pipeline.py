@@ -0,0 +1,106 @@
+"""
+Background indexing of chat messages. The event loop only queues a message
+with the names of its recipients; one worker thread tokenizes it and adds it
+to the shared MessageStore in batches, so indexing is no longer paid for
+before delivery.
+
+Every submitted message gets a sequence number. A search that must see every
+message already delivered to the user (read-your-writes) is run through
+after(): the callback runs once the worker has applied everything submitted
+before it. It runs on the worker thread, so it must be quick: the server's
+callback only hands the search to its search pool, and indexing never
+waits for disk reads.
+
+call() queues a change to the store's users (login, logout) in the same
+sequence as the messages, so a message submitted before a logout is still
+in that session's history, and one submitted after a new login is in the
+new session's.
+"""
+import collections
+import threading
+
+INDEX_BATCH = 256       # messages applied per batch
+INDEX_QUEUE = 100000    # beyond this, submit() waits for the worker (back-pressure)
+
+
+class IndexPipeline:
+    def __init__(self, store, batch=INDEX_BATCH, max_queue=INDEX_QUEUE):
+        self.store = store
+        self.batch = batch
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.waiters = []               # (seq, fn) run once seq is applied
+        self.submitted = 0
+        self.applied = 0
+        self.cond = threading.Condition()
+        # held while the store is written; take it to read the store
+        self.lock = threading.Lock()
+        t = threading.Thread(target=self.work, name='indexer')
+        t.daemon = True
+        t.start()
+
+    def submit(self, text, users):
+        """Queue text for the store, visible to users; returns its sequence number."""
+        if not users:
+            return self.submitted
+        with self.cond:
+            while len(self.queue) >= self.max_queue:
+                self.cond.wait()
+            self.submitted += 1
+            self.queue.append((self.submitted, text, users))
+            self.cond.notify_all()
+            return self.submitted
+
+    def call(self, fn, *args):
+        """Run fn(*args) on the worker, with the store lock held, after every
+        message submitted before it; returns its sequence number."""
+        with self.cond:
+            while len(self.queue) >= self.max_queue:
+                self.cond.wait()
+            self.submitted += 1
+            self.queue.append((self.submitted, None, (fn, args)))
+            self.cond.notify_all()
+            return self.submitted
+
+    def after(self, seq, fn, *args):
+        """Run fn(*args) once everything up to seq is indexed: now, or on the worker."""
+        with self.cond:
+            if self.applied < seq:
+                self.waiters.append((seq, fn, args))
+                return
+        fn(*args)
+
+    def pending(self):
+        with self.cond:
+            return len(self.queue)
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                n = min(len(self.queue), self.batch)
+                batch = [self.queue.popleft() for _ in range(n)]
+                self.cond.notify_all()  # a submit() may be waiting for room
+            # tokenize outside the lock, so searches only wait for the postings
+            batch_words = [self.store.tokenize(text) if text is not None else None
+                           for seq, text, users in batch]
+            with self.lock:
+                for (seq, text, users), words in zip(batch, batch_words):
+                    try:
+                        if text is None:
+                            fn, args = users    # queued by call()
+                            fn(*args)
+                        else:
+                            self.store.add(text, users, words)
+                    except Exception as e:
+                        print(f"[IndexPipeline] indexing error: {e}")
+            with self.cond:
+                self.applied = batch[-1][0]
+                ready = [w for w in self.waiters if w[0] <= self.applied]
+                self.waiters = [w for w in self.waiters if w[0] > self.applied]
+            for seq, fn, args in ready:
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"[IndexPipeline] callback error: {e}")
@@ -4,15 +4,241 @@ Created on Sat Jul  5 11:38:58 2014
 
 @author: zzhang
 """
+import array
+import bisect
+import collections
+import heapq
+import math
 import pickle
+import re
+import sys
+
+from analyzer import DEFAULT_ANALYZER, WHITESPACE, get_analyzer
+
+# BM25 ranking
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_LIMIT = 20
+
+# term expansion (lov*, l*ly, luve~)
+FUZZY_MAX_EDITS = 2
+EXPANSION_MAX = 128     # terms a pattern may expand to, most frequent kept
+EXPANSION_CACHE = 256   # patterns whose expansion is remembered
+
+# postings are ascending line numbers. In memory they are array('I') (4 bytes
+# each instead of a 28-byte int object plus an 8-byte list slot); on disk they
+# are delta + varint encoded, mostly 1-2 bytes per posting. delta=False
+# varint-encodes values that are not ascending (word positions).
+def encode_postings(postings, delta=True):
+    out = bytearray()
+    prev = 0
+    for n in postings:
+        d = n - prev
+        if delta:
+            prev = n
+        while d >= 0x80:
+            out.append((d & 0x7f) | 0x80)
+            d >>= 7
+        out.append(d)
+    return bytes(out)
+
+def decode_postings(data, delta=True):
+    postings = array.array('I')
+    n = shift = prev = 0
+    for b in data:
+        n |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            if delta:
+                prev += n
+                postings.append(prev)
+            else:
+                postings.append(n)
+            n = shift = 0
+    return postings
+
+# ==============================================================================
+# Queries: words are ANDed, OR separates alternatives, NOT excludes the next
+# word or "quoted phrase".   love NOT hate OR "summer's day"
+# A word may also be a pattern, expanded against the term dictionary:
+#   lov*  prefix      l*ly  wildcard      luve~  luve~2  fuzzy (edit distance)
+# ==============================================================================
+QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+FUZZY_TOKEN = re.compile(r'^(.+?)~(\d)?$')
+
+def term_pattern(word, analyze):
+    # (kind, text, max edits) for a pattern word, None for a plain one
+    fuzzy = FUZZY_TOKEN.match(word)
+    if fuzzy:
+        text = fuzzy.group(1)
+        edits = int(fuzzy.group(2)) if fuzzy.group(2) else (1 if len(text) <= 4 else 2)
+        kind, edits = 'fuzzy', min(edits, FUZZY_MAX_EDITS)
+    elif '*' in word:
+        text = word.rstrip('*') if '*' not in word.rstrip('*') else word
+        kind, edits = ('prefix' if text != word else 'wildcard'), 0
+    else:
+        return None
+    if getattr(analyze, 'lowercase', False):
+        text = text.lower()
+    if not text.replace('*', ''):
+        return None     # a bare * would match every term
+    return (kind, text, edits)
+
+def parse_query(query, analyze=WHITESPACE):
+    # -> list of OR'ed clauses, each a list of (negated, words) ANDed together;
+    # words holds one term, or several for a phrase. A word the analyzer cuts
+    # into several terms (a CJK run, "x-ray") is matched as a phrase.
+    clauses = [[]]
+    negate = False
+    for m in QUERY_TOKEN.finditer(query):
+        phrase, word = m.groups()
+        if word == 'OR':
+            clauses.append([])
+        elif word == 'NOT':
+            negate = True
+        elif word != 'AND':
+            pattern = term_pattern(word, analyze) if phrase is None else None
+            words = [pattern] if pattern else analyze(phrase if phrase is not None else word)
+            if words:
+                clauses[-1].append((negate, words))
+            negate = False
+    return [clause for clause in clauses if clause]
+
+# sorted postings (a line id may repeat, once per occurrence) are combined by
+# walking the shorter list and galloping through the longer one, so a rare
+# term AND a common one costs about len(rare) * log(len(common))
+def gallop(a, x, lo=0):
+    # first i >= lo with a[i] >= x
+    n = len(a)
+    step = 1
+    hi = lo
+    while hi < n and a[hi] < x:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect.bisect_left(a, x, lo, min(hi, n))
+
+def intersect(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    result = array.array('I')
+    j = 0
+    last = -1
+    for x in a:
+        if x == last:
+            continue
+        last = x
+        j = gallop(b, x, j)
+        if j == len(b):
+            break
+        if b[j] == x:
+            result.append(x)
+    return result
+
+def union(a, b):
+    result = array.array('I')
+    last = -1
+    for x in heapq.merge(a, b):
+        if x != last:
+            result.append(x)
+            last = x
+    return result
+
+def difference(a, b):
+    # a must not repeat ids
+    result = array.array('I')
+    j = 0
+    for x in a:
+        j = gallop(b, x, j)
+        if j == len(b) or b[j] != x:
+            result.append(x)
+    return result
+
+def scan_terms(terms, pattern):
+    # the terms of a sorted list that match a pattern from term_pattern
+    kind, text, edits = pattern
+    if kind == 'fuzzy':
+        return fuzzy_terms(terms, text, edits)
+    prefix = text.split('*', 1)[0]
+    found = []
+    i = bisect.bisect_left(terms, prefix)
+    if kind == 'prefix':
+        while i < len(terms) and terms[i].startswith(prefix):
+            found.append(terms[i])
+            i += 1
+        return found
+    regex = re.compile('.*'.join(re.escape(part) for part in text.split('*')), re.S)
+    while i < len(terms) and terms[i].startswith(prefix):
+        if regex.fullmatch(terms[i]):
+            found.append(terms[i])
+        i += 1
+    return found
+
+def fuzzy_terms(terms, word, edits):
+    # terms of a sorted list within `edits` edits of word. One Levenshtein
+    # row per character of the term; the rows of the prefix shared with the
+    # previous term are kept, and a branch stops once every cell exceeds edits
+    n = len(word)
+    rows = [list(range(n + 1))]
+    prev = ''
+    found = []
+    for t in terms:
+        if abs(len(t) - n) > edits:
+            continue
+        common = 0
+        limit = min(len(prev), len(t))
+        while common < limit and prev[common] == t[common]:
+            common += 1
+        del rows[common + 1:]
+        for i in range(common, len(t)):
+            above = rows[-1]
+            c = t[i]
+            row = [above[0] + 1]
+            for j in range(1, n + 1):
+                row.append(min(above[j] + 1, row[j - 1] + 1, above[j - 1] + (word[j - 1] != c)))
+            rows.append(row)
+            if min(row) > edits:
+                break
+        prev = t[:len(rows) - 1]
+        if len(rows) == len(t) + 1 and rows[-1][n] <= edits:
+            found.append(t)
+    return found
+
+def unique(a):
+    result = array.array('I')
+    last = -1
+    for x in a:
+        if x != last:
+            result.append(x)
+            last = x
+    return result
+
+def add_stats(a, b):
+    # sum two (messages, words, {term: df}) of query_stats
+    df = dict(a[2])
+    for term, n in b[2].items():
+        df[term] = df.get(term, 0) + n
+    return a[0] + b[0], a[1] + b[1], df
 
 class Index:
-    def __init__(self, name):
+    __slots__ = ('name', 'msgs', 'index', 'total_msgs', 'total_words', 'lens',
+                 'df', 'analyzer', 'term_order', 'terms', 'n_sorted', 'expansions')
+    # rebuilt from index when loaded, not pickled
+    TERM_SLOTS = ('term_order', 'terms', 'n_sorted', 'expansions')
+
+    def __init__(self, name, analyzer=DEFAULT_ANALYZER):
         self.name = name
+        self.analyzer = get_analyzer(analyzer)  # applied to messages and queries alike
         self.msgs = [];
         self.index = {}
         self.total_msgs = 0
         self.total_words = 0
+        self.lens = array.array('I')    # words per message, for BM25
+        # no word positions are kept: a phrase is checked by tokenizing the
+        # few lines that hold all of its words (see has_phrase)
+        self.df = {}                    # term -> number of messages holding it
+        self.reset_terms()
         
     def get_total_words(self):
         return self.total_words
@@ -23,34 +249,232 @@ class Index:
     def get_msg(self, n):
         return self.msgs[n]
         
+    def tokenize(self, m):
+        return self.analyzer(m)
+
     def add_msg(self, m):
         self.msgs.append(m)
         self.total_msgs += 1
         
-    def add_msg_and_index(self, m):
+    def add_msg_and_index(self, m, words=None):
+        # words: tokens of m, when the caller already has them
         self.add_msg(m)
         line_at = self.total_msgs - 1
-        self.indexing(m, line_at)
+        self.indexing(m, line_at, words)
  
-    def indexing(self, m, l):
-        words = m.split()
+    def indexing(self, m, l, words=None):
+        if words is None:
+            words = self.analyzer(m)
         self.total_words += len(words)
+        lens = self.lens
+        while len(lens) <= l:
+            lens.append(0)
+        lens[l] = len(words)
+        index = self.index
+        df = self.df
         for wd in words:
-            if wd not in self.index:
-                self.index[wd] = [l,]
-            else:
-                self.index[wd].append(l)
+            postings = index.get(wd)
+            if postings is None:
+                # one shared string per distinct term, whichever message it came from
+                wd = sys.intern(wd)
+                postings = index[wd] = array.array('I')
+                df[wd] = 1
+                self.term_order.append(wd)
+            elif postings[-1] != l:
+                df[wd] += 1
+            postings.append(l)
+
+    def __getstate__(self):
+        # subclasses (PIndex) may keep extra attributes in a __dict__
+        state = dict(getattr(self, '__dict__', {}))
+        state.update((slot, getattr(self, slot)) for slot in Index.__slots__
+                     if slot not in Index.TERM_SLOTS)
+        state['index'] = {wd: encode_postings(p) for wd, p in self.index.items()}
+        state['analyzer'] = self.analyzer.name
+        return state
+
+    def __setstate__(self, state):
+        # positions were kept for a while; phrases no longer need them
+        state.pop('positions', None)
+        for key, value in state.items():
+            setattr(self, key, value)
+        if 'df' not in state:
+            # an .idx file from before df was kept: index it again
+            self.analyzer = get_analyzer(DEFAULT_ANALYZER)
+            self.index, self.df = {}, {}
+            self.lens = array.array('I')
+            self.total_words = 0
+            self.reset_terms()
+            for l, m in enumerate(self.msgs):
+                self.indexing(m, l)
+            return
+        # terms of files written before analyzers existed came from m.split()
+        self.analyzer = get_analyzer(state.get('analyzer', WHITESPACE.name))
+        self.index = {sys.intern(wd): decode_postings(p) for wd, p in self.index.items()}
+        self.reset_terms()
+        self.term_order.extend(self.index)
+
+    # ==========================================================================
+    # Term dictionary: every term in sorted order, for pattern expansion
+    # ==========================================================================
+    def reset_terms(self):
+        self.term_order = []    # terms in the order they were first seen
+        self.terms = []         # sorted, covers term_order[:n_sorted]
+        self.n_sorted = 0
+        self.expansions = collections.OrderedDict()   # pattern -> (terms seen, matches)
+
+    def sorted_terms(self):
+        # merge the terms added since the last call into the sorted list
+        if self.n_sorted < len(self.term_order):
+            new = sorted(self.term_order[self.n_sorted:])
+            self.terms = list(heapq.merge(self.terms, new)) if self.terms else new
+            self.n_sorted = len(self.term_order)
+        return self.terms
+
+    def expand(self, pattern):
+        # the most frequent terms matching pattern. Matches are cached per
+        # pattern and only terms that are new since then are checked again
+        entry = self.expansions.get(pattern)
+        if entry is None:
+            found = set(scan_terms(self.sorted_terms(), pattern))
+        else:
+            self.expansions.move_to_end(pattern)
+            seen, found = entry
+            if seen < len(self.term_order):
+                found = found.union(scan_terms(sorted(self.term_order[seen:]), pattern))
+        self.expansions[pattern] = (len(self.term_order), found)
+        if len(self.expansions) > EXPANSION_CACHE:
+            self.expansions.popitem(last=False)
+        if len(found) <= EXPANSION_MAX:
+            return sorted(found)
+        return sorted(heapq.nlargest(EXPANSION_MAX, found, key=self.df.get))
                                      
     def search(self, term):
         msgs = []
-        if (term in self.index.keys()):
+        if term in self.index:
             indices = self.index[term]
             msgs = [(i, self.msgs[i]) for i in indices]
         return msgs
 
+    def phrase_lines(self, words):
+        # lines holding words next to each other, in this order
+        lines = None
+        for wd in words:
+            postings = self.index.get(wd)
+            if postings is None:
+                return array.array('I')
+            lines = postings if lines is None else intersect(lines, postings)
+        result = array.array('I')
+        for line in unique(lines):
+            if self.has_phrase(line, words):
+                result.append(line)
+        return result
+
+    def has_phrase(self, line, words):
+        # line holds every word of the phrase; are they next to each other?
+        tokens = self.analyzer(self.msgs[line])
+        k = len(words)
+        for i, t in enumerate(tokens):
+            if t == words[0] and tokens[i:i + k] == words:
+                return True
+        return False
+
+    def item_lines(self, words):
+        # postings of one term (ids may repeat), the lines of a phrase, or
+        # the lines holding any expansion of a pattern
+        if isinstance(words[0], tuple):
+            return unique(heapq.merge(*[self.index[t] for t in self.expand(words[0])]))
+        if len(words) == 1:
+            return self.index.get(words[0], array.array('I'))
+        return self.phrase_lines(words)
+
+    def item_terms(self, words):
+        return self.expand(words[0]) if isinstance(words[0], tuple) else words
+
+    def query_terms(self, clauses):
+        # the terms a match is scored on: NOT items only filter
+        return {wd for clause in clauses for negated, words in clause if not negated
+                for wd in self.item_terms(words)}
+
+    def query_stats(self, query):
+        """
+        (messages, words, {term: df}) of this index for the terms of query.
+        Summed with add_stats over several indexes and passed to search_top,
+        they give each index the same idf and average length, so scores
+        from different indexes can be compared.
+        """
+        df = self.df
+        terms = self.query_terms(parse_query(query, self.analyzer))
+        return self.total_msgs, self.total_words, {t: df.get(t, 0) for t in terms}
+
+    def match(self, clauses, visible=None):
+        """Ascending ids of the lines matching parsed clauses, within visible if given."""
+        result = array.array('I')
+        for clause in clauses:
+            wanted = [self.item_lines(words) for negated, words in clause if not negated]
+            # rarest first, so every intersection gallops through the longer list
+            wanted.sort(key=len)
+            if visible is not None:
+                wanted.append(visible)
+            if not wanted:
+                wanted.append(array.array('I', range(self.total_msgs)))
+            lines = wanted[0]
+            for other in wanted[1:]:
+                if not lines:
+                    break
+                lines = intersect(lines, other)
+            if len(wanted) == 1:
+                lines = unique(lines)
+            for negated, words in clause:
+                if negated and lines:
+                    lines = difference(lines, self.item_lines(words))
+            result = union(result, lines) if result else lines
+        return result
+
+    def search_top(self, query, limit=SEARCH_LIMIT, offset=0, visible=None, stats=None):
+        """
+        BM25-ranked search (see parse_query for the syntax). Returns (total,
+        hits): the number of matching messages and the hits ranked offset ..
+        offset + limit - 1 as (score, line, msg), best first (newest first on
+        ties). visible: sorted line numbers the caller may see, None for all.
+        stats: collection statistics to score with (see query_stats), when
+        the hits are merged with those of other indexes; this index's own
+        if None.
+        """
+        clauses = parse_query(query, self.analyzer)
+        lines = self.match(clauses, visible)
+        if not lines:
+            return 0, []
+        n_docs, total_words, dfs = stats if stats is not None else (self.total_msgs, self.total_words, self.df)
+        avgdl = total_words / n_docs or 1.0
+        lens = self.lens
+        scores = dict.fromkeys(lines, 0.0)
+        for term in self.query_terms(clauses):
+            postings = self.index.get(term)
+            if not postings:
+                continue
+            df = dfs.get(term) or self.df[term]
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            # postings repeat a line once per occurrence: the run length is tf
+            j = 0
+            for line in lines:
+                j = gallop(postings, line, j)
+                k = j
+                while k < len(postings) and postings[k] == line:
+                    k += 1
+                tf = k - j
+                j = k
+                if tf:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * lens[line] / avgdl)
+                    scores[line] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        # keep only the best offset + limit in a heap instead of sorting everything
+        top = heapq.nlargest(offset + limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return len(scores), [(score, line, self.msgs[line]) for line, score in top[offset:]]
+
 class PIndex(Index):
     def __init__(self, name):
-        super().__init__(name)
+        # get_poem looks up the headings ("III.") verbatim
+        super().__init__(name, WHITESPACE.name)
         roman_int_f = open('roman.txt.pk', 'rb')
         self.int2roman = pickle.load(roman_int_f)
         roman_int_f.close()
@@ -36,17 +36,12 @@ class Index:
         words = m.split()
         self.total_words += len(words)
         for wd in words:
-            self.index[wd] = self.index.get(wd, []) + [l] 
-    #### Alternatively, the following also works
-#        for wd in words:
-#            try:
-#                self.index[wd]+= [l]
-#            except KeyError:
-#                self.index[wd] = [l]
+            # append in place: get(wd, []) + [l] copied the whole list every time
+            self.index.setdefault(wd, []).append(l)
                                      
     def search(self, term):
         msgs = []
-        if term in self.index.keys():
+        if term in self.index:
             indices = self.index[term]
             msgs = [(i, self.msgs[i]) for i in indices]
         return msgs
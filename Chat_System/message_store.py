@@ -0,0 +1,103 @@
+"""
+One store for every chat message, shared by all users. Each message is kept
+and indexed once, under an integer id; what a user may search is the sorted
+array of ids delivered to them, applied as a filter at query time. A message
+to a 50-person group costs one copy, one set of postings and 50 small
+integers.
+
+The store only holds what online users can search: each message counts the
+id arrays it is in, a message nobody online received is not stored at all,
+and once no one who can see a message is online any more it is dead. When
+at least half the store is dead (and COMPACT_MIN messages, or all of it),
+compact() drops the dead messages and renumbers the rest, so the store
+follows the users online, not the traffic since the server started.
+Messages of users who logged out live on in their disk history.
+"""
+import array
+
+from analyzer import DEFAULT_ANALYZER
+from indexer import Index, SEARCH_LIMIT, unique
+
+COMPACT_MIN = 4096      # dead messages before the store is compacted
+
+
+class MessageStore(Index):
+    __slots__ = ('visible', 'refs', 'dead', 'compact_min')
+
+    def __init__(self, name='messages', analyzer=DEFAULT_ANALYZER, compact_min=COMPACT_MIN):
+        super().__init__(name, analyzer)
+        self.visible = {}   # user -> array('I') of message ids, ascending
+        self.refs = array.array('I')    # message id -> id arrays it is in
+        self.dead = 0       # messages with no reference left, until compact()
+        self.compact_min = compact_min
+
+    def open_user(self, user):
+        if user not in self.visible:
+            self.visible[user] = array.array('I')
+
+    def close_user(self, user):
+        # stop tracking user; returns the messages delivered to them meanwhile
+        ids = self.visible.pop(user, ())
+        msgs = [self.msgs[i] for i in ids]
+        refs = self.refs
+        for i in ids:
+            refs[i] -= 1
+            if not refs[i]:
+                self.dead += 1
+        if self.dead * 2 >= self.total_msgs and (self.dead >= self.compact_min or self.dead == self.total_msgs):
+            self.compact()
+        return msgs
+
+    def has_user(self, user):
+        return user in self.visible
+
+    def add(self, m, users, words=None):
+        # store and index m once, make it visible to the users still online;
+        # None if none of them is
+        targets = [ids for ids in (self.visible.get(user) for user in users) if ids is not None]
+        if not targets:
+            return None
+        self.add_msg_and_index(m, words)
+        msg_id = self.total_msgs - 1
+        for ids in targets:
+            ids.append(msg_id)
+        self.refs.append(len(targets))
+        return msg_id
+
+    def compact(self):
+        # drop the dead messages and their postings; the live ones are
+        # renumbered in order, so every id array stays ascending
+        refs = self.refs
+        keep = [i for i in range(self.total_msgs) if refs[i]]
+        new_id = array.array('I', bytes(4 * self.total_msgs))
+        for new, old in enumerate(keep):
+            new_id[old] = new
+        index = {}
+        df = {}
+        for wd, postings in self.index.items():
+            kept = array.array('I', [new_id[i] for i in postings if refs[i]])
+            if kept:
+                index[wd] = kept
+                df[wd] = len(unique(kept))
+        self.index = index
+        self.df = df
+        self.msgs = [self.msgs[i] for i in keep]
+        self.lens = array.array('I', [self.lens[i] for i in keep])
+        self.refs = array.array('I', [refs[i] for i in keep])
+        self.total_msgs = len(keep)
+        self.total_words = sum(self.lens)
+        for user, ids in self.visible.items():
+            self.visible[user] = array.array('I', [new_id[i] for i in ids])
+        self.dead = 0
+        self.reset_terms()
+        self.term_order.extend(index)
+
+    def msg_count(self, user):
+        return len(self.visible.get(user, ()))
+
+    def search_top_for(self, user, query, limit=SEARCH_LIMIT, offset=0, stats=None):
+        # BM25 over the whole store, restricted to what user can see
+        ids = self.visible.get(user)
+        if not ids:
+            return 0, []
+        return self.search_top(query, limit, offset, visible=ids, stats=stats)
@@ -0,0 +1,195 @@
+"""
+Store-and-forward delivery for users who are offline.
+
+Room messages are not copied per member: every one is already in the
+message log (and the room's ring), so a user who logs out only leaves a
+read cursor, the last message id they could have seen. On login the server
+collects the messages of their rooms after the cursor (the backlog). The
+cursors are saved in offline/cursors.json.
+
+Messages meant for one person (a connect attempt) are appended to
+offline/<user>.q, the user name hex-encoded, as length-prefixed JSON records
+{"ts": enqueue time, "msg": the outbound message}.
+
+drain() merges the two by time, drops what is older than the TTL, keeps the
+newest max_msgs messages / max_bytes bytes and hands them to the server in
+one batch of frames. To keep put() an append, a queue file is only
+rewritten to the caps once it has grown a quarter past them.
+"""
+import json
+import os
+import struct
+import time
+
+from chat_utils import name_to_file, file_to_name
+
+OFFLINE_DIR = "offline"
+OFFLINE_MAX = 1000                  # messages kept per user
+OFFLINE_MAX_BYTES = 1024 * 1024     # bytes kept per user
+OFFLINE_TTL = 7 * 24 * 3600         # seconds a message waits before it is dropped
+
+RECORD = struct.Struct('<I')
+QUEUE_SUFFIX = '.q'
+CURSORS = 'cursors.json'
+
+
+def read_queue(path):
+    # [(ts, msg, record bytes)], oldest first; a torn final record is ignored
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    entries = []
+    pos = 0
+    while pos + RECORD.size <= len(data):
+        (n,) = RECORD.unpack_from(data, pos)
+        body = data[pos + RECORD.size:pos + RECORD.size + n]
+        if len(body) < n:
+            break
+        record = json.loads(body)
+        entries.append((record["ts"], record["msg"], RECORD.size + n))
+        pos += RECORD.size + n
+    return entries
+
+
+class OfflineQueues:
+    def __init__(self, root=OFFLINE_DIR, max_msgs=OFFLINE_MAX, max_bytes=OFFLINE_MAX_BYTES, ttl=OFFLINE_TTL):
+        self.root = root
+        self.max_msgs = max_msgs
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+        # user -> [messages, bytes] on disk, for the caps and the depth metrics
+        self.depth = {}
+        for f in os.listdir(root):
+            name = file_to_name(f[:-len(QUEUE_SUFFIX)]) if f.endswith(QUEUE_SUFFIX) else None
+            if name is not None:
+                entries = read_queue(os.path.join(root, f))
+                if entries:
+                    self.depth[name] = [len(entries), sum(e[2] for e in entries)]
+        # offline user -> message id their room backlog starts after
+        self.cursors = {}
+        try:
+            with open(os.path.join(root, CURSORS), encoding='utf-8') as f:
+                self.cursors = json.load(f)
+        except FileNotFoundError:
+            pass
+        self.cursors_dirty = False
+        self.enqueued = 0
+        self.dropped = 0    # over the caps
+        self.expired = 0    # over the TTL
+        self.drained = 0
+        self.drains = 0
+        self.drain_seconds = 0.0
+        self.drain_max = 0.0
+
+    def path(self, name):
+        return os.path.join(self.root, name_to_file(name) + QUEUE_SUFFIX)
+
+    def has_queue(self, name):
+        return name in self.depth or name in self.cursors
+
+    def set_cursor(self, name, msg_id):
+        self.cursors[name] = msg_id
+        self.cursors_dirty = True
+
+    def cursor(self, name):
+        return self.cursors.get(name)
+
+    def save_cursors(self):
+        # like the rooms file: written at most once per loop round, atomically
+        if not self.cursors_dirty:
+            return
+        tmp = os.path.join(self.root, CURSORS + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.cursors, f)
+        os.replace(tmp, os.path.join(self.root, CURSORS))
+        self.cursors_dirty = False
+
+    def put(self, names, msg):
+        # queue msg for every user in names; it is encoded once
+        body = json.dumps({"ts": round(time.time(), 3), "msg": msg}).encode()
+        record = RECORD.pack(len(body)) + body
+        for name in names:
+            with open(self.path(name), 'ab') as f:
+                f.write(record)
+            depth = self.depth.setdefault(name, [0, 0])
+            depth[0] += 1
+            depth[1] += len(record)
+            self.enqueued += 1
+            if depth[0] > self.max_msgs * 5 // 4 or depth[1] > self.max_bytes * 5 // 4:
+                self.compact(name)
+
+    def live(self, name, backlog=()):
+        # the queued messages plus the (ts, msg, bytes) backlog, within TTL
+        # and caps, oldest first; counts the rest
+        entries = read_queue(self.path(name)) if name in self.depth else []
+        if backlog:
+            entries = sorted(entries + list(backlog), key=lambda e: e[0])
+        cutoff = time.time() - self.ttl
+        fresh = [e for e in entries if e[0] >= cutoff]
+        self.expired += len(entries) - len(fresh)
+        keep = 0
+        size = 0
+        for ts, msg, n in reversed(fresh):
+            if keep == self.max_msgs or size + n > self.max_bytes:
+                break
+            keep += 1
+            size += n
+        self.dropped += len(fresh) - keep
+        return fresh[len(fresh) - keep:]
+
+    def compact(self, name):
+        entries = self.live(name)
+        tmp = self.path(name) + '.tmp'
+        with open(tmp, 'wb') as f:
+            for ts, msg, n in entries:
+                body = json.dumps({"ts": ts, "msg": msg}).encode()
+                f.write(RECORD.pack(len(body)) + body)
+        os.replace(tmp, self.path(name))
+        self.depth[name] = [len(entries), sum(e[2] for e in entries)]
+
+    def drain(self, name, deliver, backlog=()):
+        """
+        Hand everything queued for name, merged with its room backlog of
+        (ts, msg, bytes), to deliver(msgs) in one call; then delete the queue
+        and the cursor. Returns the number of messages delivered.
+        """
+        if name not in self.depth and not backlog:
+            self.forget_cursor(name)
+            return 0
+        start = time.perf_counter()
+        msgs = []
+        for ts, msg, n in self.live(name, backlog):
+            msg["offline"] = ts
+            msgs.append(msg)
+        if msgs:
+            deliver(msgs)
+        if name in self.depth:
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                pass
+            del self.depth[name]
+        self.forget_cursor(name)
+        elapsed = time.perf_counter() - start
+        self.drained += len(msgs)
+        self.drains += 1
+        self.drain_seconds += elapsed
+        self.drain_max = max(self.drain_max, elapsed)
+        return len(msgs)
+
+    def forget_cursor(self, name):
+        if self.cursors.pop(name, None) is not None:
+            self.cursors_dirty = True
+
+    def stats(self):
+        return {"users": len(self.depth), "cursors": len(self.cursors),
+                "depth": sum(d[0] for d in self.depth.values()),
+                "bytes": sum(d[1] for d in self.depth.values()),
+                "max_depth": max((d[0] for d in self.depth.values()), default=0),
+                "enqueued": self.enqueued, "dropped": self.dropped, "expired": self.expired,
+                "drained": self.drained, "drains": self.drains,
+                "drain_ms_avg": round(1000 * self.drain_seconds / self.drains, 3) if self.drains else 0.0,
+                "drain_ms_max": round(1000 * self.drain_max, 3)}
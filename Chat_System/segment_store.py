@@ -0,0 +1,580 @@
+"""
+On-disk message history, one directory per user:
+
+    history/<user>/segments.json   the live segments, oldest first
+    history/<user>/seg-000001.dat  immutable segments (memory-mapped)
+    history/<user>/tail.log        append-only tail: length-prefixed messages
+
+where <user> is the user name hex-encoded (chat_utils.name_to_file), so a
+name can never reach outside the history directory.
+
+Logging out appends the session's messages to the tail. Once the tail holds
+TAIL_MAX messages a background thread turns it into a segment. Whenever the
+newest MERGE_FACTOR segments are about the same size, they are merged into
+one, so a user never has more than a few segments per size tier.
+
+A history is only loaded when its user searches it; the HistoryStore keeps
+the recently searched ones resident, least recently used first out, within
+a memory budget. Loading maps the segment files and reads the bounded tail,
+so it costs the same however long the history is. Logging out while the
+history is not resident just appends to tail.log. A SegmentReader is an Index
+whose postings, positions, messages and terms are read straight out of the
+mapping on demand, so search, boolean queries and term expansion work on a
+segment unchanged.
+
+Segment layout (native byte order, every section 8-byte aligned):
+
+    header     magic, analyzer name, n_msgs, n_terms, total_words, 10 section offsets
+    msg_off    Q * (n_msgs + 1)       msg_blob   UTF-8 messages
+    lens       I * n_msgs
+    term_off   Q * (n_terms + 1)      term_blob  UTF-8 terms, sorted
+    df         I * n_terms
+    post_off   Q * (n_terms + 1)      post_blob  delta + varint line ids
+    pos_off    Q * (n_terms + 1)      pos_blob   varint word positions
+
+A segment is searched with the analyzer it was written with, whatever the
+server's --analyzer is now; merging rewrites it with the current one.
+Segments from before the analyzer was recorded (CHATSEG1) are rebuilt with
+the current analyzer when their history is loaded.
+"""
+import array
+import bisect
+import collections
+import functools
+import heapq
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+
+from analyzer import DEFAULT_ANALYZER, get_analyzer
+from indexer import Index, encode_postings, decode_postings, add_stats, SEARCH_LIMIT
+from chat_utils import name_to_file
+
+HISTORY_DIR = "history"
+TAIL_MAX = 1000         # tail messages before they are written out as a segment
+MERGE_FACTOR = 4        # this many similar-sized segments are merged into one
+POSTINGS_CACHE = 1024   # decoded postings kept per segment
+HISTORY_BUDGET = 64     # MB of resident histories (tails and decoded postings)
+
+SEG_MAGIC = b'CHATSEG2'
+SEG_HEADER = struct.Struct('=8s16sIIQ10Q')
+SEG_MAGIC_V1 = b'CHATSEG1'                  # no analyzer name in the header
+SEG_HEADER_V1 = struct.Struct('=8sIIQ10Q')
+TAIL_RECORD = struct.Struct('<I')
+MANIFEST = 'segments.json'
+TAIL = 'tail.log'
+
+
+# ==============================================================================
+# Writing
+# ==============================================================================
+def write_segment(path, msgs, analyzer=DEFAULT_ANALYZER):
+    # index msgs in memory, then lay the result out as one segment file
+    index = Index(os.path.basename(path), analyzer)
+    positions = {}  # term -> word offsets, parallel to index[term]; the Index keeps none
+    for m in msgs:
+        words = index.tokenize(m)
+        index.add_msg_and_index(m, words)
+        for pos, wd in enumerate(words):
+            offsets_of = positions.get(wd)
+            if offsets_of is None:
+                offsets_of = positions[wd] = array.array('I')
+            offsets_of.append(pos)
+    terms = sorted(index.index)
+    encoded_msgs = [m.encode('utf-8') for m in index.msgs]
+    encoded_terms = [t.encode('utf-8') for t in terms]
+    postings = [encode_postings(index.index[t]) for t in terms]
+    positions = [encode_postings(positions[t], delta=False) for t in terms]
+
+    def offsets(blobs):
+        out = array.array('Q', [0])
+        for b in blobs:
+            out.append(out[-1] + len(b))
+        return out.tobytes()
+
+    sections = [offsets(encoded_msgs), b''.join(encoded_msgs), index.lens.tobytes(),
+                offsets(encoded_terms), b''.join(encoded_terms),
+                array.array('I', (index.df[t] for t in terms)).tobytes(),
+                offsets(postings), b''.join(postings),
+                offsets(positions), b''.join(positions)]
+    starts = []
+    pos = SEG_HEADER.size
+    for data in sections:
+        pos += -pos % 8
+        starts.append(pos)
+        pos += len(data)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SEG_HEADER.pack(SEG_MAGIC, index.analyzer.name.encode(), index.total_msgs, len(terms),
+                                index.total_words, *starts))
+        for start, data in zip(starts, sections):
+            f.write(b'\0' * (start - f.tell()))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# ==============================================================================
+# Reading: an Index backed by a memory-mapped segment
+# ==============================================================================
+class _Blobs:
+    # sequence view over (offsets, blob): item i is blob[off[i]:off[i+1]]
+    def __init__(self, offs, blob, decode):
+        self.offs = offs
+        self.blob = blob
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offs) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.decode(self.blob[self.offs[i]:self.offs[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class _TermMap:
+    # the dict-like face of one per-term section (postings, positions or df)
+    def __init__(self, reader, fetch):
+        self.reader = reader
+        self.fetch = fetch
+
+    def get(self, term, default=None):
+        tid = self.reader.term_id(term)
+        return default if tid is None else self.fetch(tid)
+
+    def __getitem__(self, term):
+        tid = self.reader.term_id(term)
+        if tid is None:
+            raise KeyError(term)
+        return self.fetch(tid)
+
+    def __contains__(self, term):
+        return self.reader.term_id(term) is not None
+
+    def __len__(self):
+        return len(self.reader.term_order)
+
+    def __iter__(self):
+        return iter(self.reader.term_order)
+
+
+class SegmentReader(Index):
+    def __init__(self, path, analyzer=DEFAULT_ANALYZER):
+        # analyzer: assumed for a CHATSEG1 segment only (legacy is then True);
+        # newer ones name the analyzer they were written with
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.map[:len(SEG_MAGIC)]
+        if magic == SEG_MAGIC:
+            magic, name, n_msgs, n_terms, total_words, *starts = SEG_HEADER.unpack_from(self.map)
+            analyzer = name.rstrip(b'\0').decode()
+        elif magic == SEG_MAGIC_V1:
+            magic, n_msgs, n_terms, total_words, *starts = SEG_HEADER_V1.unpack_from(self.map)
+        else:
+            raise ValueError("not a segment: " + path)
+        self.legacy = magic == SEG_MAGIC_V1
+        self.analyzer = get_analyzer(analyzer)
+        view = memoryview(self.map)
+        size = [(n_msgs + 1) * 8, None, n_msgs * 4, (n_terms + 1) * 8, None,
+                n_terms * 4, (n_terms + 1) * 8, None, (n_terms + 1) * 8, None]
+        parts = []
+        for i, start in enumerate(starts):
+            end = start + size[i] if size[i] is not None else (starts[i + 1] if i + 1 < len(starts) else len(view))
+            parts.append(view[start:end])
+        msg_off, msg_blob, lens, term_off, term_blob, df, post_off, post_blob, pos_off, pos_blob = parts
+        msg_off, post_off, pos_off, term_off = (p.cast('Q') for p in (msg_off, post_off, pos_off, term_off))
+
+        self.total_msgs = n_msgs
+        self.total_words = total_words
+        self.lens = lens.cast('I')
+        self.msgs = _Blobs(msg_off, msg_blob, lambda b: str(b, 'utf-8'))
+        # sorted already: bisect, prefix scans and fuzzy matching work on it as is
+        self.term_order = self.terms = _Blobs(term_off, term_blob, lambda b: str(b, 'utf-8'))
+        self.n_sorted = n_terms
+        self.expansions = collections.OrderedDict()
+        self.cache = collections.OrderedDict()
+        dfs = df.cast('I')
+        postings = _Blobs(post_off, post_blob, decode_postings)
+        positions = _Blobs(pos_off, pos_blob, lambda b: decode_postings(b, delta=False))
+        self.index = _TermMap(self, lambda tid: self.cached(('p', tid), postings))
+        self.positions = _TermMap(self, lambda tid: self.cached(('w', tid), positions))
+        self.df = _TermMap(self, lambda tid: dfs[tid])
+
+    def term_id(self, term):
+        i = bisect.bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def cached(self, key, blobs):
+        value = self.cache.get(key)
+        if value is None:
+            value = self.cache[key] = blobs[key[1]]
+            if len(self.cache) > POSTINGS_CACHE:
+                self.cache.popitem(last=False)
+        return value
+
+    def has_phrase(self, line, words):
+        # a segment has the word positions on disk: no need to tokenize the line
+        starts = set(self.positions_in(words[0], line))
+        for k in range(1, len(words)):
+            starts.intersection_update(p - k for p in self.positions_in(words[k], line))
+            if not starts:
+                return False
+        return bool(starts)
+
+    def positions_in(self, wd, line):
+        postings = self.index[wd]
+        lo = bisect.bisect_left(postings, line)
+        hi = bisect.bisect_right(postings, line, lo)
+        return self.positions[wd][lo:hi]
+
+    def add_msg_and_index(self, m, words=None):
+        raise TypeError("segments are immutable")
+
+    def __reduce__(self):
+        raise TypeError("segments are files; pickle the path instead")
+
+
+# ==============================================================================
+# One user's history
+# ==============================================================================
+def encode_tail(msgs):
+    return b''.join(TAIL_RECORD.pack(len(b)) + b for b in (m.encode('utf-8') for m in msgs))
+
+
+def append_tail(path, msgs):
+    with open(path, 'ab') as f:
+        f.write(encode_tail(msgs))
+
+
+def tail_count(path):
+    # messages in a tail file, from the length prefixes alone
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0
+    pos = n_msgs = 0
+    while pos + TAIL_RECORD.size <= len(data):
+        pos += TAIL_RECORD.size + TAIL_RECORD.unpack_from(data, pos)[0]
+        if pos <= len(data):
+            n_msgs += 1
+    return n_msgs
+
+
+def read_tail(path):
+    msgs = []
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return msgs
+    pos = 0
+    while pos + TAIL_RECORD.size <= len(data):
+        (n,) = TAIL_RECORD.unpack_from(data, pos)
+        if pos + TAIL_RECORD.size + n > len(data):
+            break   # torn final record from a crash mid-append
+        pos += TAIL_RECORD.size
+        msgs.append(data[pos:pos + n].decode('utf-8'))
+        pos += n
+    return msgs
+
+
+class UserHistory:
+    def __init__(self, path, analyzer=DEFAULT_ANALYZER):
+        self.path = path
+        self.analyzer = analyzer
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        manifest = self.load_manifest()
+        self.next_seg = manifest["next"]
+        self.segments = []
+        rebuilt = []
+        for name in manifest["segments"]:
+            reader = SegmentReader(os.path.join(path, name), analyzer)
+            if reader.legacy:
+                # which analyzer wrote it is unknown: index it again with ours
+                rebuilt.append(name)
+                name = self.new_segment_name()
+                write_segment(os.path.join(path, name), list(reader.msgs), analyzer)
+                reader = SegmentReader(os.path.join(path, name), analyzer)
+            self.segments.append((name, reader))
+        if rebuilt:
+            self.save_manifest()
+            for old in rebuilt:
+                try:
+                    os.remove(os.path.join(path, old))
+                except OSError:
+                    pass    # still mapped (Windows)
+        self.tail = Index('tail', analyzer)
+        self.tail_bytes = 0
+        for m in read_tail(os.path.join(path, TAIL)):
+            self.add_to_tail(m)
+        self.busy = False   # a flush / merge of this history is queued or running
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"segments": [], "next": 1}
+
+    def save_manifest(self):
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({"segments": [name for name, reader in self.segments], "next": self.next_seg}, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def add_to_tail(self, m):
+        self.tail.add_msg_and_index(m)
+        self.tail_bytes += len(m)
+
+    def append(self, msgs):
+        # logout: add the session's messages to the tail. True if the tail is full
+        with self.lock:
+            append_tail(os.path.join(self.path, TAIL), msgs)
+            for m in msgs:
+                self.add_to_tail(m)
+            return self.tail.total_msgs >= TAIL_MAX
+
+    def memory(self):
+        """
+        Rough bytes held in memory: tail messages with their postings, plus
+        the decoded postings cached by each segment. The mapped segment
+        files themselves are page cache the OS can drop.
+        """
+        with self.lock:
+            sources = [reader for name, reader in self.segments]
+            used = self.tail_bytes + 4 * self.tail.total_words
+        for reader in sources:
+            used += sum(len(p) * p.itemsize for p in list(reader.cache.values()))
+        return used
+
+    def msg_count(self):
+        with self.lock:
+            return sum(r.total_msgs for name, r in self.segments) + self.tail.total_msgs
+
+    def query_stats(self, query):
+        # summed over the segments and the tail, like Index.query_stats
+        with self.lock:
+            sources = [reader for name, reader in self.segments] + [self.tail]
+        return functools.reduce(add_stats, (source.query_stats(query) for source in sources))
+
+    def search_top(self, query, limit=SEARCH_LIMIT, offset=0, stats=None):
+        """
+        Each segment and the tail ranks with the same collection statistics
+        (stats, or those of the whole history if None); the best offset +
+        limit of all of them win, newer first on ties. Returns (total, hits)
+        with hits as (score, (segment number, line), msg), like
+        Index.search_top.
+        """
+        with self.lock:
+            sources = [reader for name, reader in self.segments] + [self.tail]
+        if stats is None:
+            stats = functools.reduce(add_stats, (source.query_stats(query) for source in sources))
+        total = 0
+        hits = []
+        for age, source in enumerate(sources):
+            n, top = source.search_top(query, offset + limit, stats=stats)
+            total += n
+            hits.extend((score, (age, line), msg) for score, line, msg in top)
+        best = heapq.nlargest(offset + limit, hits, key=lambda hit: hit[:2])
+        return total, best[offset:]
+
+    # --------------------------------------------------------------------------
+    # background work, run by the HistoryStore merge thread
+    # --------------------------------------------------------------------------
+    def new_segment_name(self):
+        name = 'seg-%06d.dat' % self.next_seg
+        self.next_seg += 1
+        return name
+
+    def flush_tail(self):
+        # write the tail out as a segment; messages appended meanwhile stay in the tail
+        with self.lock:
+            msgs = list(self.tail.msgs)
+            name = self.new_segment_name()
+        if not msgs:
+            return
+        write_segment(os.path.join(self.path, name), msgs, self.analyzer)
+        reader = SegmentReader(os.path.join(self.path, name), self.analyzer)
+        with self.lock:
+            rest = self.tail.msgs[len(msgs):]
+            self.segments.append((name, reader))
+            self.save_manifest()
+            tail_path = os.path.join(self.path, TAIL)
+            with open(tail_path + '.tmp', 'wb') as f:
+                f.write(encode_tail(rest))
+            os.replace(tail_path + '.tmp', tail_path)
+            self.tail = Index('tail', self.analyzer)
+            self.tail_bytes = 0
+            for m in rest:
+                self.add_to_tail(m)
+
+    def merge_candidates(self):
+        # the newest MERGE_FACTOR segments, if they are in the same size tier
+        # (the biggest less than MERGE_FACTOR times the smallest)
+        with self.lock:
+            newest = self.segments[-MERGE_FACTOR:]
+        if len(newest) < MERGE_FACTOR:
+            return None
+        sizes = [reader.total_msgs for name, reader in newest]
+        if max(sizes) >= MERGE_FACTOR * max(1, min(sizes)):
+            return None
+        return newest
+
+    def merge(self, victims):
+        msgs = [m for name, reader in victims for m in reader.msgs]
+        with self.lock:
+            name = self.new_segment_name()
+        write_segment(os.path.join(self.path, name), msgs, self.analyzer)
+        reader = SegmentReader(os.path.join(self.path, name), self.analyzer)
+        with self.lock:
+            i = self.segments.index(victims[0])
+            self.segments[i:i + len(victims)] = [(name, reader)]
+            self.save_manifest()
+        for old, r in victims:
+            try:
+                os.remove(os.path.join(self.path, old))
+            except OSError:
+                pass    # still mapped (Windows); unreferenced after the next merge
+
+    def compact(self):
+        while self.tail.total_msgs >= TAIL_MAX:
+            self.flush_tail()
+        victims = self.merge_candidates()
+        while victims:
+            self.merge(victims)
+            victims = self.merge_candidates()
+
+
+class HistoryStore:
+    def __init__(self, root=HISTORY_DIR, analyzer=DEFAULT_ANALYZER, budget=HISTORY_BUDGET):
+        self.root = root
+        self.analyzer = analyzer
+        self.budget = budget * 2 ** 20
+        # resident histories, least recently used first, with their last
+        # measured memory(); a history being compacted is never evicted
+        self.resident = collections.OrderedDict()
+        self.sizes = {}
+        self.used = 0
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        t = threading.Thread(target=self.work, name='history-merge')
+        t.daemon = True
+        t.start()
+
+    def get(self, name):
+        # the user's history, loaded on first use
+        with self.lock:
+            history = self.resident.get(name)
+            if history is None:
+                history = self.resident[name] = UserHistory(self.path(name), self.analyzer)
+                self.sizes[name] = 0
+            self.resident.move_to_end(name)
+            return history
+
+    def path(self, name):
+        return os.path.join(self.root, name_to_file(name))
+
+    def has_history(self, name):
+        # False for a user who never logged out with messages
+        return os.path.isdir(self.path(name))
+
+    def query_stats(self, name, query):
+        if not self.has_history(name):
+            return 0, 0, {}
+        return self.get(name).query_stats(query)
+
+    def search_top(self, name, query, limit=SEARCH_LIMIT, offset=0, stats=None):
+        if not self.has_history(name):
+            return 0, []
+        history = self.get(name)
+        result = history.search_top(query, limit, offset, stats)
+        self.measure(name, history)
+        return result
+
+    def append(self, name, msgs):
+        # logout: append to the tail now, compact later on the merge thread
+        if not msgs:
+            return
+        with self.lock:
+            history = self.resident.get(name)
+            if history is None:
+                path = self.path(name)
+                os.makedirs(path, exist_ok=True)
+                append_tail(os.path.join(path, TAIL), msgs)
+                if tail_count(os.path.join(path, TAIL)) < TAIL_MAX:
+                    return
+        if history is None:
+            history = self.get(name)
+            full = True
+        else:
+            full = history.append(msgs)
+        with self.lock:
+            if full and not history.busy and self.resident.get(name) is history:
+                history.busy = True
+                self.jobs.put(('compact', name, history))
+        self.measure(name, history)
+
+    def append_later(self, name, msgs):
+        # like append(), on the merge thread: for callers that must not wait
+        # for disk. Appends of one user keep their order
+        if msgs:
+            self.jobs.put(('append', name, msgs))
+
+    def measure(self, name, history):
+        used = history.memory()
+        with self.lock:
+            if self.resident.get(name) is history:
+                self.used += used - self.sizes[name]
+                self.sizes[name] = used
+            self.evict()
+
+    def evict(self):
+        # drop least recently used histories until within budget. Everything a
+        # history holds is already on disk (the tail is written through on
+        # append), so dropping it only unmaps files and frees caches
+        for name in list(self.resident):
+            if self.used <= self.budget:
+                break
+            if self.resident[name].busy:
+                continue
+            del self.resident[name]
+            self.used -= self.sizes.pop(name)
+
+    def work(self):
+        while True:
+            kind, name, job = self.jobs.get()
+            if kind == 'append':
+                try:
+                    self.append(name, job)
+                except Exception as e:
+                    print(f"[HistoryStore] cannot save history of {name}: {e}")
+                continue
+            history = job
+            ok = True
+            try:
+                history.compact()
+            except Exception as e:
+                print(f"[HistoryStore] compaction error: {e}")
+                ok = False
+            with self.lock:
+                # logouts that filled the tail again while we worked saw busy
+                # and queued nothing: queue the history again for them
+                if ok and history.tail.total_msgs >= TAIL_MAX and self.resident.get(name) is history:
+                    self.jobs.put(('compact', name, history))
+                else:
+                    history.busy = False
+            self.measure(name, history)
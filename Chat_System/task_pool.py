@@ -0,0 +1,71 @@
+"""
+Shared, bounded worker pool for the slow AI tasks (bot_ask, /summary,
+/keyword). A fixed number of daemon threads pull work from a bounded
+priority queue, so a burst of requests can neither spawn hundreds of
+threads nor grow memory without limit.
+"""
+import heapq
+import itertools
+import threading
+
+PRIO_INTERACTIVE = 0    # @bot questions, someone is waiting for the answer
+PRIO_BATCH = 1          # /summary and /keyword
+
+AI_WORKERS = 4
+AI_QUEUE = 64
+
+# a second pool runs searches, which may load and read on-disk histories
+SEARCH_WORKERS = 2
+SEARCH_QUEUE = 256
+
+
+class TaskPool:
+    def __init__(self, workers=AI_WORKERS, max_queue=AI_QUEUE, name='ai-worker'):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue = []
+        self.seq = itertools.count()
+        self.running = 0
+        self.cond = threading.Condition()
+        for i in range(workers):
+            t = threading.Thread(target=self.work, name='%s-%d' % (name, i))
+            t.daemon = True
+            t.start()
+
+    def submit(self, prio, fn, *args):
+        """
+        Queue fn(*args). Returns 0 if an idle worker will pick it up right
+        away, N > 0 if it waits behind N - 1 other tasks, or -1 if the
+        queue is full and the task was rejected.
+        """
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                return -1
+            entry = (prio, next(self.seq), fn, args)
+            idle = self.workers - self.running - len(self.queue)
+            position = 0
+            if idle <= 0:
+                # everything ahead of us in (priority, arrival) order, plus us
+                position = 1 + sum(1 for e in self.queue if e[:2] < entry[:2])
+            heapq.heappush(self.queue, entry)
+            self.cond.notify()
+            return position
+
+    def pending(self):
+        with self.cond:
+            return len(self.queue)
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                prio, seq, fn, args = heapq.heappop(self.queue)
+                self.running += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[TaskPool] task error: {e}")
+            finally:
+                with self.cond:
+                    self.running -= 1
@@ -0,0 +1,51 @@
+"""
+Checks that logins and logouts queued in the IndexPipeline split messages
+between sessions in the order they were submitted.
+
+    python test_index_pipeline.py      (or pytest)
+"""
+import threading
+
+from index_pipeline import IndexPipeline
+from message_store import MessageStore
+
+
+def test_logout_keeps_messages_still_queued():
+    store = MessageStore()
+    pipeline = IndexPipeline(store)
+    closed = []
+    done = threading.Event()
+    pipeline.call(store.open_user, "alice")
+    with pipeline.lock:
+        # the worker cannot apply anything yet: all of this is still queued
+        pipeline.submit("before logout one", ["alice"])
+        pipeline.submit("before logout two", ["alice"])
+        pipeline.call(lambda: closed.append(store.close_user("alice")))
+        pipeline.call(store.open_user, "alice")
+        pipeline.submit("after login", ["alice"])
+        seq = pipeline.submitted
+    pipeline.after(seq, done.set)
+    assert done.wait(5)
+    assert closed == [["before logout one", "before logout two"]]
+    with pipeline.lock:
+        assert store.close_user("alice") == ["after login"]
+
+
+def test_after_waits_for_calls_too():
+    store = MessageStore()
+    pipeline = IndexPipeline(store)
+    seen = []
+    done = threading.Event()
+    with pipeline.lock:
+        pipeline.call(store.open_user, "bob")
+        seq = pipeline.submit("hello bob", ["bob", "carl"])
+    pipeline.after(seq, lambda: (seen.append(store.search_top_for("bob", "hello")[0]), done.set()))
+    assert done.wait(5)
+    assert seen == [1]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(name, "ok")
@@ -0,0 +1,74 @@
+"""
+Checks that the shared MessageStore only holds what online users can see.
+
+    python test_message_store.py      (or pytest)
+"""
+import sys
+
+from message_store import MessageStore
+
+
+def store_bytes(store):
+    # what the store holds itself: messages, postings, per-message arrays
+    size = sum(sys.getsizeof(x) for x in (store.msgs, store.index, store.df, store.lens, store.refs))
+    size += sum(sys.getsizeof(m) for m in store.msgs)
+    return size + sum(sys.getsizeof(p) for p in store.index.values())
+
+
+def fill(store, users, n):
+    for i in range(n):
+        store.add("message %d about love and roses %s" % (i, "x" * (i % 50)), users)
+
+
+def test_store_shrinks_after_everyone_logs_out():
+    store = MessageStore(compact_min=1000)
+    empty = store_bytes(store)
+    for user in ("alice", "bob", "carl"):
+        store.open_user(user)
+    fill(store, ["alice", "bob"], 3000)
+    fill(store, ["bob", "carl"], 3000)
+    full = store_bytes(store)
+    assert store.total_msgs == 6000
+
+    assert len(store.close_user("alice")) == 3000
+    # bob still sees alice's messages
+    assert store.total_msgs == 6000
+    assert len(store.close_user("bob")) == 6000
+    # only carl's 3000 are left, renumbered from 0
+    assert store.total_msgs == 3000
+    assert store_bytes(store) < full * 2 / 3
+    assert list(store.visible["carl"]) == list(range(3000))
+    assert store.search_top_for("carl", "roses")[0] == 3000
+    assert store.search_top_for("carl", "2999")[1][0][2].startswith("message 2999 ")
+    assert len(store.close_user("carl")) == 3000
+    assert store.total_msgs == 0 and not store.msgs and not store.index and not store.df
+    assert store_bytes(store) == empty
+
+
+def test_messages_nobody_online_sees_are_not_kept():
+    store = MessageStore()
+    store.open_user("alice")
+    assert store.add("hello there", ["alice", "bob"]) == 0
+    assert store.add("to bob only", ["bob"]) is None
+    assert store.total_msgs == 1
+    assert store.search_top_for("alice", "hello")[0] == 1
+
+
+def test_search_after_partial_compaction():
+    store = MessageStore(compact_min=10)
+    store.open_user("alice")
+    store.open_user("bob")
+    fill(store, ["alice"], 30)
+    fill(store, ["bob"], 20)
+    store.close_user("alice")
+    assert store.total_msgs == 20 and store.dead == 0
+    total, hits = store.search_top_for("bob", "roses", limit=5)
+    assert total == 20 and len(hits) == 5
+    assert store.df["roses"] == 20
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_"):
+            fn()
+            print(name, "ok")